@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+docx -> epub 转换后端
+LibreOffice 和 Pandoc 各有擅长的文档，这里把转换器抽象成可注册的后端：
+
+- libreoffice: 原有的 LibreOffice 转换
+- pandoc: 调用 pandoc 命令行，或连接本地启动的 pandoc server，避免每个文件都启动一次进程
+- auto: 按校准结果为每个文档选择最快且输出质量合格的后端
+
+校准模式会在语料的抽样上为每个后端计时并做质量检查，结果按文档类别保存到 JSON 文件。
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import base64
+import random
+import shutil
+import socket
+import zipfile
+import logging
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+from collections import defaultdict
+
+from coreConver import DEFAULT_CONFIG, convert_docx_to_epub, get_docx_files
+import governor
+
+# 默认配置
+BACKEND_CONFIG = {
+    "PANDOC_PATH": "pandoc",
+    "PANDOC_SERVER_PORT": 3030,
+    "CALIBRATION_FILE": "backend_calibration.json",
+    "SAMPLE_SIZE": 20,          # 每个文档类别抽样的文档数
+    "MIN_TEXT_RATIO": 0.9,      # epub 正文字数至少要达到 docx 的这个比例
+    "DEFAULT_BACKEND": "libreoffice"
+}
+
+BACKENDS = {}
+
+
+def register_backend(cls):
+    """注册转换后端的类装饰器"""
+    BACKENDS[cls.name] = cls
+    return cls
+
+
+def get_backend(name, **options):
+    """按名称创建后端实例，options 中各后端只取自己需要的参数"""
+    if name not in BACKENDS:
+        raise ValueError(f"未知的转换后端: {name}，可选: {', '.join(BACKENDS)}")
+    return BACKENDS[name](**options)
+
+
+class ConverterBackend:
+    """转换后端接口
+
+    convert 与 coreConver.convert_docx_to_epub 约定一致：
+    在 output_folder 中生成与 docx 同名的 epub，成功返回 True
+    """
+    name = None
+
+    def available(self):
+        return True
+
+    def convert(self, file_path, output_folder):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@register_backend
+class LibreOfficeBackend(ConverterBackend):
+    name = "libreoffice"
+
+    def __init__(self, libreoffice_path=DEFAULT_CONFIG["LIBREOFFICE_PATH"], user_installation=None, **_):
+        self.libreoffice_path = libreoffice_path
+        self.user_installation = user_installation
+
+    def available(self):
+        return os.path.exists(self.libreoffice_path) or shutil.which(self.libreoffice_path) is not None
+
+    def convert(self, file_path, output_folder):
+        return convert_docx_to_epub(
+            file_path,
+            output_folder=output_folder,
+            libreoffice_path=self.libreoffice_path,
+            user_installation=self.user_installation
+        )
+
+
+@register_backend
+class PandocBackend(ConverterBackend):
+    name = "pandoc"
+
+    def __init__(self, pandoc_path=BACKEND_CONFIG["PANDOC_PATH"], pandoc_server=None,
+                 start_server=False, server_port=BACKEND_CONFIG["PANDOC_SERVER_PORT"], **_):
+        """
+        :param pandoc_server: 已运行的 pandoc server 地址，例如 http://127.0.0.1:3030
+        :param start_server: 为 True 时在本地启动 pandoc server 并在 close() 时关闭
+        """
+        self.pandoc_path = pandoc_path
+        self.server_url = pandoc_server
+        self.server_process = None
+        if start_server and not pandoc_server:
+            self._start_server(server_port)
+
+    def _start_server(self, port):
+        self.server_process = subprocess.Popen(
+            [self.pandoc_path, "server", "--port", str(port)],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        self.server_url = f"http://127.0.0.1:{port}"
+        # 等待端口可连接
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            if self.server_process.poll() is not None:
+                break
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                    logging.info(f"已启动 pandoc server: {self.server_url}")
+                    return
+            except OSError:
+                time.sleep(0.2)
+        self.close()
+        raise RuntimeError("pandoc server 启动失败")
+
+    def available(self):
+        return self.server_url is not None or shutil.which(self.pandoc_path) is not None
+
+    def convert(self, file_path, output_folder):
+        os.makedirs(output_folder, exist_ok=True)
+        epub_name = os.path.splitext(os.path.basename(file_path))[0] + ".epub"
+        epub_path = os.path.join(output_folder, epub_name)
+        try:
+            if self.server_url:
+                self._convert_via_server(file_path, epub_path)
+            else:
+                governor.run(
+                    "pandoc",
+                    [self.pandoc_path, file_path, "-f", "docx", "-t", "epub3", "-o", epub_path],
+                    input_size=os.path.getsize(file_path),
+                    check=True,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    text=True
+                )
+            logging.info(f"成功转换: {file_path} -> {epub_path}")
+            return True
+        except subprocess.CalledProcessError as e:
+            logging.error(f"转换失败: {file_path} - {e.stderr}")
+        except Exception as e:
+            logging.error(f"处理文件出错: {file_path} - {str(e)}")
+        return False
+
+    def _convert_via_server(self, file_path, epub_path):
+        with open(file_path, "rb") as f:
+            payload = {
+                "text": base64.b64encode(f.read()).decode("ascii"),
+                "from": "docx",
+                "to": "epub3",
+                "standalone": True
+            }
+        request = urllib.request.Request(
+            self.server_url,
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json", "Accept": "application/json"}
+        )
+        with urllib.request.urlopen(request, timeout=600) as response:
+            result = json.loads(response.read().decode("utf-8"))
+        output = result["output"]
+        data = base64.b64decode(output) if result.get("base64") else output.encode("utf-8")
+        with open(epub_path, "wb") as f:
+            f.write(data)
+
+    def close(self):
+        if self.server_process is not None:
+            self.server_process.terminate()
+            self.server_process.wait()
+            self.server_process = None
+
+
+@register_backend
+class AutoBackend(ConverterBackend):
+    """按校准结果为每个文档选择后端"""
+    name = "auto"
+
+    def __init__(self, calibration_file=BACKEND_CONFIG["CALIBRATION_FILE"], **options):
+        self.calibration = load_calibration(calibration_file)
+        self.options = options
+        self.backends = {}
+
+    def _backend(self, name):
+        if name not in self.backends:
+            self.backends[name] = get_backend(name, **self.options)
+        return self.backends[name]
+
+    def convert(self, file_path, output_folder):
+        name = select_backend(file_path, self.calibration)
+        backend = self._backend(name)
+        if not backend.available():
+            backend = self._backend(BACKEND_CONFIG["DEFAULT_BACKEND"])
+        logging.info(f"{os.path.basename(file_path)} 使用后端: {backend.name}")
+        return backend.convert(file_path, output_folder)
+
+    def close(self):
+        for backend in self.backends.values():
+            backend.close()
+        self.backends = {}
+
+
+# 文档分类与质量检查
+
+def _docx_stats(docx_path):
+    """返回 (正文字数, 图片数, 是否含表格, 图片总大小)"""
+    try:
+        with zipfile.ZipFile(docx_path) as z:
+            document = z.read("word/document.xml").decode("utf-8", errors="ignore")
+            images = [n for n in z.namelist() if n.startswith("word/media/")]
+            media_size = sum(z.getinfo(n).file_size for n in images)
+    except (zipfile.BadZipFile, KeyError):
+        return 0, 0, False, 0
+    text = "".join(re.findall(r"<w:t(?:\s[^>]*)?>([^<]*)</w:t>", document))
+    return len(re.sub(r"\s", "", text)), len(images), "<w:tbl>" in document, media_size
+
+
+def classify_document(docx_path):
+    """把文档分为 image / table / text 三类，用于分别校准"""
+    _, image_count, has_table, media_size = _docx_stats(docx_path)
+    if image_count and media_size > os.path.getsize(docx_path) / 2:
+        return "image"
+    if has_table:
+        return "table"
+    return "text"
+
+
+def check_output(docx_path, epub_path):
+    """基本质量检查：epub 结构完整，正文、图片和表格没有丢失"""
+    try:
+        with zipfile.ZipFile(epub_path) as z:
+            names = z.namelist()
+            if "mimetype" not in names:
+                return False
+            pages = [z.read(n).decode("utf-8", errors="ignore") for n in names
+                     if n.endswith((".xhtml", ".html")) and not n.endswith(("toc.xhtml", "nav.xhtml"))]
+            epub_images = [n for n in names if os.path.splitext(n)[1].lower() in
+                           (".png", ".jpg", ".jpeg", ".gif", ".svg", ".webp", ".bmp", ".emf", ".wmf")]
+    except (zipfile.BadZipFile, FileNotFoundError):
+        return False
+    if not pages:
+        return False
+
+    text_count, image_count, has_table, _ = _docx_stats(docx_path)
+    body = "".join(re.sub(r"<[^>]+>", "", re.sub(r"<head>.*?</head>", "", p, flags=re.DOTALL)) for p in pages)
+    if len(re.sub(r"\s", "", body)) < text_count * BACKEND_CONFIG["MIN_TEXT_RATIO"]:
+        return False
+    if len(epub_images) < image_count:
+        return False
+    if has_table and not any("<table" in p for p in pages):
+        return False
+    return True
+
+
+# 校准
+
+def load_calibration(calibration_file=BACKEND_CONFIG["CALIBRATION_FILE"]):
+    if not os.path.exists(calibration_file):
+        return {}
+    with open(calibration_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def calibrate(docx_files, backend_names=None, sample_size=BACKEND_CONFIG["SAMPLE_SIZE"],
+              calibration_file=BACKEND_CONFIG["CALIBRATION_FILE"], **options):
+    """在抽样文档上为每个后端计时并做质量检查，结果写入 calibration_file
+
+    :return: {文档类别: {后端名: {"seconds": 平均耗时, "passed": 合格数, "total": 样本数}}}
+    """
+    by_class = defaultdict(list)
+    for docx in docx_files:
+        by_class[classify_document(docx)].append(docx)
+
+    backend_names = backend_names or [n for n in BACKENDS if n != AutoBackend.name]
+    backends = [get_backend(n, **options) for n in backend_names]
+    backends = [b for b in backends if b.available()]
+
+    result = {}
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for doc_class, files in by_class.items():
+            sample = random.sample(files, min(sample_size, len(files)))
+            result[doc_class] = {}
+            for backend in backends:
+                seconds = 0.0
+                passed = 0
+                for docx in sample:
+                    output_folder = os.path.join(temp_dir, backend.name)
+                    started = time.perf_counter()
+                    ok = backend.convert(docx, output_folder)
+                    seconds += time.perf_counter() - started
+                    epub = os.path.join(output_folder, os.path.splitext(os.path.basename(docx))[0] + ".epub")
+                    if ok and check_output(docx, epub):
+                        passed += 1
+                    if os.path.exists(epub):
+                        os.remove(epub)
+                result[doc_class][backend.name] = {
+                    "seconds": seconds / len(sample),
+                    "passed": passed,
+                    "total": len(sample)
+                }
+                print(f"{doc_class:6} {backend.name:12} 平均 {seconds / len(sample):.2f}s，合格 {passed}/{len(sample)}")
+    finally:
+        for backend in backends:
+            backend.close()
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    with open(calibration_file, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    logging.info(f"校准结果已保存到 {calibration_file}")
+    return result
+
+
+def select_backend(docx_path, calibration):
+    """选择该文档类别下样本全部合格且平均耗时最短的后端"""
+    candidates = calibration.get(classify_document(docx_path), {})
+    qualified = [
+        (stats["seconds"], name) for name, stats in candidates.items()
+        if name in BACKENDS and stats["total"] and stats["passed"] == stats["total"]
+    ]
+    if not qualified:
+        return BACKEND_CONFIG["DEFAULT_BACKEND"]
+    return min(qualified)[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="docx -> epub 转换后端校准")
+    parser.add_argument("root", help="OneNoteExport 根目录")
+    parser.add_argument("-n", "--sample-size", type=int, default=BACKEND_CONFIG["SAMPLE_SIZE"], help="每个文档类别的抽样数")
+    parser.add_argument("-o", "--output", default=BACKEND_CONFIG["CALIBRATION_FILE"], help="校准结果文件")
+    parser.add_argument("-b", "--backends", nargs="+", default=None, help="参与校准的后端，默认全部")
+    parser.add_argument("--libreoffice-path", default=DEFAULT_CONFIG["LIBREOFFICE_PATH"], help="LibreOffice 路径")
+    parser.add_argument("--pandoc-path", default=BACKEND_CONFIG["PANDOC_PATH"], help="pandoc 路径")
+    parser.add_argument("--pandoc-server", default=None, help="已运行的 pandoc server 地址")
+    parser.add_argument("--start-pandoc-server", action="store_true", help="在本地启动 pandoc server")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.root):
+        print(f"错误: 文件夹 '{args.root}' 不存在")
+        return 1
+
+    docx_files = []
+    for root, _, _ in os.walk(args.root):
+        docx_files.extend(get_docx_files(root))
+    if not docx_files:
+        print(f"在 '{args.root}' 中没有找到docx文件")
+        return 1
+
+    calibrate(
+        docx_files,
+        backend_names=args.backends,
+        sample_size=args.sample_size,
+        calibration_file=args.output,
+        libreoffice_path=args.libreoffice_path,
+        pandoc_path=args.pandoc_path,
+        pandoc_server=args.pandoc_server,
+        start_server=args.start_pandoc_server
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
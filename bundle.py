@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+章节包（chapter bundle）中间格式
+每个页面原本要经过完整的 epub 容器：LibreOffice 写出 OPF、toc.ncx 并打包，
+anlyze_epub 解压再重新打包，合并时又解压一次然后丢掉容器。
+
+章节包只保存页面的 XHTML、它引用的资源和一份小的元数据 bundle.json
+（标题、层级路径、顺序、哈希），保存为不压缩的 zip 归档。
+转换阶段读一次 LibreOffice 的 epub 生成章节包，合并阶段直接读章节包生成最终 epub，
+只有最终输出才会构建完整的 epub 容器。
+"""
+
+import io
+import os
+import re
+import html
+import uuid
+import json
+import hashlib
+import posixpath
+import zipfile
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import quote, unquote
+from xml.etree import ElementTree
+
+from coreConver import insert_title_into_content
+from epub_writer import write_epub
+
+# 默认配置
+BUNDLE_CONFIG = {
+    "LANGUAGE": "zh"    # 源 epub 没有语言信息时使用
+}
+
+BUNDLE_SUFFIX = ".bundle"
+META_NAME = "bundle.json"
+
+_OPF_NS = "{http://www.idpf.org/2007/opf}"
+_DC_NS = "{http://purl.org/dc/elements/1.1/}"
+_CONTAINER_NS = "{urn:oasis:names:tc:opendocument:xmlns:container}"
+_NCX_TYPE = "application/x-dtbncx+xml"
+
+
+def page_order(docx_path):
+    """onenote_to_docx 导出的文件名形如 003_标题.docx，返回其中的序号"""
+    match = re.match(r"(\d+)_", os.path.basename(docx_path))
+    return int(match.group(1)) if match else 0
+
+
+def hierarchy_of(folder, root_dir=None):
+    """页面所在文件夹相对于 OneNoteExport 根目录的层级（笔记本/分区组/分区）"""
+    if root_dir:
+        try:
+            return list(Path(folder).resolve().relative_to(Path(root_dir).resolve()).parts)
+        except ValueError:
+            pass
+    return [Path(folder).name]
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _read_opf(z):
+    """返回 (opf 所在目录, manifest {id: (href, media-type, properties)}, spine [id], 语言)"""
+    container = ElementTree.fromstring(z.read("META-INF/container.xml"))
+    rootfile = container.find(f".//{_CONTAINER_NS}rootfile")
+    if rootfile is None:
+        rootfile = container.find(".//rootfile")
+    opf_path = rootfile.attrib["full-path"]
+    opf = ElementTree.fromstring(z.read(opf_path))
+
+    manifest = {}
+    for item in opf.iter(f"{_OPF_NS}item"):
+        manifest[item.attrib["id"]] = (
+            unquote(item.attrib["href"]),
+            item.attrib.get("media-type", ""),
+            item.attrib.get("properties", "")
+        )
+    spine = [ref.attrib["idref"] for ref in opf.iter(f"{_OPF_NS}itemref")]
+    language = opf.find(f".//{_DC_NS}language")
+    return (
+        posixpath.dirname(opf_path),
+        manifest,
+        spine,
+        language.text if language is not None and language.text else None
+    )
+
+
+def epub_to_bundle_data(epub, name, source=None, hierarchy=None, order=None):
+    """读取单页 epub 并修正标题，返回章节包的 (元数据, {相对路径: 内容})
+
+    同时完成原来 anlyze_epub 做的标题修正，整个过程只读一次 epub，不再重新打包。
+
+    :param epub: epub 路径或 bytes 内容
+    :param name: 页面名称（不含扩展名）
+    :param source: 对应的 docx 路径，用于元数据
+    """
+    if isinstance(epub, (bytes, bytearray)):
+        epub = io.BytesIO(epub)
+    with zipfile.ZipFile(epub) as z:
+        opf_dir, manifest, spine, language = _read_opf(z)
+        files = {}
+        resources = {}
+        for item_id, (href, media_type, properties) in manifest.items():
+            if "nav" in properties.split() or media_type == _NCX_TYPE:
+                continue
+            data = z.read(posixpath.normpath(posixpath.join(opf_dir, href)))
+            files[href] = data
+            resources[href] = {
+                "media_type": media_type,
+                "properties": properties,
+                "sha256": _sha256(data)
+            }
+
+    # 修正标题（与 anlyze_epub 一致）
+    title = None
+    spine_hrefs = [manifest[i][0] for i in spine if manifest[i][0] in files]
+    for href in spine_hrefs:
+        if not href.endswith(".xhtml"):
+            continue
+        content, page_title = insert_title_into_content(files[href].decode("utf-8"))
+        if content is not None:
+            files[href] = content.encode("utf-8")
+            resources[href]["sha256"] = _sha256(files[href])
+            # 取自 XHTML 的标题已经转义过，bundle.json 中保存纯文本，生成目录时再转义
+            title = title or html.unescape(page_title)
+
+    meta = {
+        "title": title or re.sub(r"^\d+_", "", name),
+        "path": list(hierarchy or []),
+        "order": page_order(name) if order is None else order,
+        "name": name,
+        "language": language,
+        "source": os.path.abspath(source) if source else None,
+        "source_sha256": None,
+        "spine": spine_hrefs,
+        "resources": resources
+    }
+    if source and os.path.exists(source):
+        with open(source, "rb") as f:
+            meta["source_sha256"] = _sha256(f.read())
+    return meta, files
+
+
+def bundle_to_bytes(meta, files):
+    """把章节包打成不压缩的 zip 归档，返回 bytes（供 storage.IntermediateStore 保存）"""
+    output = io.BytesIO()
+    _write_archive(output, meta, files)
+    return output.getvalue()
+
+
+def _write_archive(output, meta, files):
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as z:
+        z.writestr(META_NAME, json.dumps(meta, ensure_ascii=False, indent=1).encode("utf-8"))
+        for href, data in files.items():
+            z.writestr(href, data)
+
+
+def _archive_member(bundle, href):
+    def read():
+        with zipfile.ZipFile(io.BytesIO(bundle) if isinstance(bundle, bytes) else bundle) as z:
+            return z.read(href)
+    return read
+
+
+def read_bundle(bundle_path):
+    """读取章节包
+
+    :param bundle_path: 章节包归档路径，或归档的 bytes 内容
+    :return: (元数据, [(相对路径, 数据来源)])，数据来源为按需读取的函数，
+             可直接交给 epub_writer.write_epub
+    """
+    if isinstance(bundle_path, (bytes, bytearray)):
+        bundle_path = bytes(bundle_path)
+        with zipfile.ZipFile(io.BytesIO(bundle_path)) as z:
+            meta = json.loads(z.read(META_NAME).decode("utf-8"))
+        entries = [(href, _archive_member(bundle_path, href)) for href in meta["resources"]]
+    else:
+        with zipfile.ZipFile(bundle_path) as z:
+            meta = json.loads(z.read(META_NAME).decode("utf-8"))
+        entries = [(href, _archive_member(bundle_path, href)) for href in meta["resources"]]
+    return meta, entries
+
+
+def sort_bundles(bundles):
+    """按 (层级路径, 页面顺序, 名称) 排序，元素可以是路径或 bytes"""
+    def sort_key(bundle):
+        meta, _ = read_bundle(bundle)
+        return meta["path"], meta["order"], meta["name"]
+    return sorted(bundles, key=sort_key)
+
+
+# 生成最终 epub
+
+def _build_toc_tree(chapters):
+    """按层级路径把章节组织成目录树，去掉所有章节共有的前缀层级"""
+    paths = [c["path"] for c in chapters]
+    common = 0
+    while paths and all(len(p) > common and p[common] == paths[0][common] for p in paths):
+        common += 1
+
+    root = {"children": []}
+    for chapter in chapters:
+        node = root
+        for name in chapter["path"][common:]:
+            last = node["children"][-1] if node["children"] else None
+            if last is None or last.get("group") != name:
+                last = {"title": name, "href": chapter["href"], "group": name, "children": []}
+                node["children"].append(last)
+            node = last
+        node["children"].append({"title": chapter["title"], "href": chapter["href"], "children": []})
+    return root["children"]
+
+
+def _render_nav(nodes):
+    items = []
+    for node in nodes:
+        li = f'<li><a href="{html.escape(node["href"])}">{html.escape(node["title"])}</a>'
+        if node["children"]:
+            li += f"<ol>{_render_nav(node['children'])}</ol>"
+        items.append(li + "</li>")
+    return "".join(items)
+
+
+def _render_ncx(nodes, counter):
+    points = []
+    for node in nodes:
+        counter[0] += 1
+        points.append(
+            f'<navPoint id="navPoint-{counter[0]}" playOrder="{counter[0]}">'
+            f'<navLabel><text>{html.escape(node["title"])}</text></navLabel>'
+            f'<content src="{html.escape(node["href"])}"/>'
+            f'{_render_ncx(node["children"], counter)}</navPoint>'
+        )
+    return "".join(points)
+
+
+def _tree_depth(nodes):
+    return 1 + max((_tree_depth(n["children"]) for n in nodes if n["children"]), default=0)
+
+
+def build_epub_from_bundles(bundle_paths, output, title, author=None, language=None):
+    """把章节包按给定顺序合成一本 epub
+
+    :param bundle_paths: 章节包路径或 bytes 内容的列表
+    :param output: 输出路径或可写的二进制文件对象
+
+    每个章节的文件放在 OEBPS/cNNNN/ 下并保持原有的相对路径，页面内部的相对链接无需改写。
+    目录按章节的层级路径分组，同时生成 EPUB3 的 nav.xhtml 和兼容旧阅读器的 toc.ncx。
+    """
+    if not bundle_paths:
+        raise FileNotFoundError("没有找到章节包")
+
+    book_id = f"urn:uuid:{uuid.uuid4()}"
+    manifest = []
+    spine = []
+    chapters = []
+    content_entries = []
+    for i, bundle_path in enumerate(bundle_paths, 1):
+        meta, entries = read_bundle(bundle_path)
+        prefix = f"c{i:04d}"
+        language = language or meta.get("language")
+        for n, (href, source) in enumerate(entries):
+            resource = meta["resources"][href]
+            item_id = f"{prefix}_{n:03d}"
+            properties = " ".join(p for p in resource.get("properties", "").split() if p != "nav")
+            properties = f' properties="{properties}"' if properties else ""
+            manifest.append(
+                f'<item id="{item_id}" href="{html.escape(quote(f"{prefix}/{href}"))}" '
+                f'media-type="{resource["media_type"]}"{properties}/>'
+            )
+            if href in meta["spine"]:
+                spine.append((meta["spine"].index(href), item_id, i))
+            content_entries.append((f"OEBPS/{prefix}/{href}", source))
+        if meta["spine"]:
+            chapters.append({
+                "title": meta["title"],
+                "path": meta["path"],
+                "href": quote(f"{prefix}/{meta['spine'][0]}")
+            })
+    # 章节之间按给定顺序，章节内部按原 spine 顺序
+    spine.sort(key=lambda s: (s[2], s[0]))
+
+    toc = _build_toc_tree(chapters)
+    title_text = html.escape(title)
+    language = language or BUNDLE_CONFIG["LANGUAGE"]
+    modified = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    creator = f"<dc:creator>{html.escape(author)}</dc:creator>" if author else ""
+    itemrefs = "".join(f'<itemref idref="{s[1]}"/>' for s in spine)
+
+    container = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+        '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+        '</rootfiles></container>'
+    )
+    opf = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid">'
+        '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        f'<dc:identifier id="bookid">{book_id}</dc:identifier>'
+        f'<dc:title>{title_text}</dc:title>'
+        f'{creator}'
+        f'<dc:language>{html.escape(language)}</dc:language>'
+        f'<meta property="dcterms:modified">{modified}</meta>'
+        '</metadata><manifest>'
+        '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+        f'<item id="ncx" href="toc.ncx" media-type="{_NCX_TYPE}"/>'
+        f'{"".join(manifest)}</manifest>'
+        f'<spine toc="ncx">{itemrefs}</spine>'
+        '</package>'
+    )
+    nav = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">'
+        f'<head><title>{title_text}</title></head><body>'
+        f'<nav epub:type="toc" id="toc"><h1>{title_text}</h1><ol>{_render_nav(toc)}</ol></nav>'
+        '</body></html>'
+    )
+    ncx = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1"><head>'
+        f'<meta name="dtb:uid" content="{book_id}"/>'
+        f'<meta name="dtb:depth" content="{_tree_depth(toc) if toc else 1}"/>'
+        '<meta name="dtb:totalPageCount" content="0"/><meta name="dtb:maxPageNumber" content="0"/>'
+        f'</head><docTitle><text>{title_text}</text></docTitle>'
+        f'<navMap>{_render_ncx(toc, [0])}</navMap></ncx>'
+    )
+
+    if not hasattr(output, "write"):
+        output = os.path.abspath(output)
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    write_epub([
+        ("META-INF/container.xml", container.encode("utf-8")),
+        ("OEBPS/content.opf", opf.encode("utf-8")),
+        ("OEBPS/nav.xhtml", nav.encode("utf-8")),
+        ("OEBPS/toc.ncx", ncx.encode("utf-8")),
+    ] + content_entries, output)
+    print(f"合并成功! 共 {len(chapters)} 个章节")
+    if isinstance(output, str):
+        print(f"输出文件: {output}")
+    return True
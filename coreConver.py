@@ -1,7 +1,10 @@
-import os,re,zipfile,tempfile
+import os,re,io,zipfile,posixpath
 import subprocess
-import logging,shutil
+import logging
+from pathlib import Path
 from typing import List
+from epub_writer import write_epub
+import governor
 
 # 默认配置
 DEFAULT_CONFIG = {
@@ -20,12 +23,13 @@ logging.basicConfig(
 
 # fixTitle
 
-def insert_title_into_head(file_path,title=None):
+def insert_title_into_content(content,title=None):
     """
     提取指定标签中的内容并插入到<head>中<link>元素后。
     如果<head>中已有<title>标签，则覆盖其内容。
-    
-    :param file_path: XHTML 文件路径
+
+    :param content: XHTML 文本
+    :return: (修改后的文本, 标题)，无法处理时返回 (None, None)
     """
     # 正则表达式匹配目标内容
     target_pattern = re.compile(r'<p class="para0">(.*?)</p>', re.DOTALL)
@@ -33,99 +37,104 @@ def insert_title_into_head(file_path,title=None):
     link_pattern = re.compile(r'(<link[^>]*>)')
     title_pattern = re.compile(r'<title>(.*?)</title>')  # 匹配已有<title>标签
 
+    # 查找目标内容
+    if title is None:
+        match = target_pattern.search(content)
+        if not match:
+            print("未找到符合条件的目标内容。")
+            return None, None
+
+        # 提取匹配的内容并去除标签
+        title = re.sub(r'<[^>]+>', '', match.group(1))
+    title_tag = f"<title>{title}</title>"
+
+    # 查找 <head> 部分
+    head_match = head_pattern.search(content)
+    if not head_match:
+        print("未找到 <head> 标签。")
+        return None, None
+
+    head_content = head_match.group(1)
+
+    # 检查是否已有<title>标签
+    existing_title_match = title_pattern.search(head_content)
+    if existing_title_match:
+        # 如果已有<title>标签，替换其内容
+        old_title_tag = existing_title_match.group(0)
+        new_head_content = head_content.replace(old_title_tag, title_tag)
+    else:
+        # 如果没有<title>标签，插入到<link>元素后面
+        link_match = link_pattern.search(head_content)
+        if not link_match:
+            print("未找到 <link> 元素。")
+            return None, None
+
+        link_tag = link_match.group(1)
+        new_head_content = head_content.replace(link_tag, f"{link_tag}\n{title_tag}")
 
+    # 替换<head>部分
+    return content.replace(head_content, new_head_content), title
+
+def insert_title_into_head(file_path,title=None):
+    """
+    对 XHTML 文件执行 insert_title_into_content 并写回
+
+    :param file_path: XHTML 文件路径
+    """
     try:
-        # 分块读取文件内容，避免一次性加载大文件
         with open(file_path, 'r', encoding='utf-8') as file:
             content = file.read()
 
-        # 查找目标内容
-        if title is None:
-            match = target_pattern.search(content)
-            if not match:
-                print("未找到符合条件的目标内容。")
-                return
-
-            # 提取匹配的内容并去除标签
-            title_content = re.sub(r'<[^>]+>', '', match.group(1))
-            title_tag = f"<title>{title_content}</title>"
-        else:
-            title_tag = f"<title>{title}</title>"
-        
-        # 查找 <head> 部分
-        head_match = head_pattern.search(content)
-        if not head_match:
-            print("未找到 <head> 标签。")
+        new_content, title = insert_title_into_content(content, title)
+        if new_content is None:
             return
-        
-        head_content = head_match.group(1)
-
-        # 检查是否已有<title>标签
-        existing_title_match = title_pattern.search(head_content)
-        if existing_title_match:
-            # 如果已有<title>标签，替换其内容
-            old_title_tag = existing_title_match.group(0)
-            new_head_content = head_content.replace(old_title_tag, title_tag)
-        else:
-            # 如果没有<title>标签，插入到<link>元素后面
-            link_match = link_pattern.search(head_content)
-            if not link_match:
-                print("未找到 <link> 元素。")
-                return
-
-            link_tag = link_match.group(1)
-            new_head_content = head_content.replace(link_tag, f"{link_tag}\n{title_tag}")
-
-        # 替换<head>部分
-        new_content = content.replace(head_content, new_head_content)
 
         # 写回文件
         with open(file_path, 'w', encoding='utf-8') as file:
             file.write(new_content)
 
-        print(f"成功插入或更新标题: {title_tag}")
+        print(f"成功插入或更新标题: <title>{title}</title>")
 
     except Exception as e:
         print(f"处理文件时发生错误: {e}")
 
+def anlyze_epub_bytes(data):
+    '''
+    输入epub文件内容，在内存中对每个xhtml文件修正标题，返回重新打包后的epub内容
+    '''
+    with zipfile.ZipFile(io.BytesIO(data), 'r') as zip_ref:
+        entries = [(name, zip_ref.read(name)) for name in zip_ref.namelist() if not name.endswith('/')]
+
+    fixed = []
+    for name, content in entries:
+        file = posixpath.basename(name)
+        if file.endswith('.xhtml') and file != 'toc.xhtml':
+            new_content, title = insert_title_into_content(content.decode('utf-8'))
+            if new_content is not None:
+                content = new_content.encode('utf-8')
+                print(f"成功插入或更新标题: <title>{title}</title>")
+        fixed.append((name, content))
+
+    output = io.BytesIO()
+    write_epub(fixed, output)
+    return output.getvalue()
+
 def anlyze_epub(file_path):
     '''
-    输入epub文件路径，解压epub文件，到一个临时文件夹中，对临时文件夹进行遍历以对每个xhtml文件进行修改
-    修改后将临时文件夹重新打包成epub文件并覆盖原文件
-    最后删除临时文件夹
+    输入epub文件路径，对其中每个xhtml文件修正标题后重新打包并覆盖原文件
+    处理在内存中完成，不再解压到临时文件夹
     '''
-    # 创建临时文件夹
-    temp_dir = tempfile.mkdtemp()
-    
     try:
-        # 解压 EPUB 文件到临时文件夹
-        with zipfile.ZipFile(file_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-        
-        # 遍历临时文件夹，找到所有 .xhtml 文件并调用 insert_title_into_head 进行修改
-        for root, _, files in os.walk(temp_dir):
-            for file in files:
-                if file.endswith('.xhtml') and file != 'toc.xhtml':
-                    xhtml_file_path = os.path.join(root, file)
-                    insert_title_into_head(xhtml_file_path)
-        
-        # 重新打包为 EPUB 文件
-        with zipfile.ZipFile(file_path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
-            for root, _, files in os.walk(temp_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, temp_dir)  # 获取相对路径
-                    zip_ref.write(file_path, arcname)
-        
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        data = anlyze_epub_bytes(data)
+        with open(file_path, 'wb') as f:
+            f.write(data)
+
         print(f"成功更新并重新打包 EPUB 文件: {file_path}")
-    
+
     except Exception as e:
         print(f"处理 EPUB 文件时发生错误: {e}")
-    
-    finally:
-        # 删除临时文件夹
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
 
 
 # /
@@ -141,9 +150,14 @@ def convert_docx_to_epub(
     file_path: str,
     output_folder: str = DEFAULT_CONFIG["OUTPUT_FOLDER"],
     delete_original: bool = DEFAULT_CONFIG["DELETE_ORIGINAL"],
-    libreoffice_path: str = DEFAULT_CONFIG["LIBREOFFICE_PATH"]
+    libreoffice_path: str = DEFAULT_CONFIG["LIBREOFFICE_PATH"],
+    user_installation: str = None
 ) -> bool:
-    """使用 LibreOffice 转换单个 docx 文件到 epub"""
+    """使用 LibreOffice 转换单个 docx 文件到 epub
+
+    user_installation: 独立的 LibreOffice 用户配置目录。同一台机器上并行运行多个
+    LibreOffice 实例时必须各自使用不同的配置目录，否则后启动的实例会直接退出。
+    """
     try:
         os.makedirs(output_folder, exist_ok=True)
         
@@ -152,16 +166,21 @@ def convert_docx_to_epub(
         epub_name = os.path.splitext(file_name)[0] + ".epub"
         epub_path = os.path.join(output_folder, epub_name)
         
-        command = [
-            libreoffice_path,
+        command = [libreoffice_path]
+        if user_installation:
+            command.append(f"-env:UserInstallation={Path(user_installation).resolve().as_uri()}")
+        command.extend([
             "--headless",
             "--convert-to", "epub",
             "--outdir", output_folder,
             file_path
-        ]
+        ])
         
-        result = subprocess.run(
+        # 经内存准入控制后启动 LibreOffice（见 governor.py）
+        result = governor.run(
+            "libreoffice",
             command,
+            input_size=os.path.getsize(file_path),
             check=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
@@ -191,8 +210,16 @@ def Cmain(
     source_folder: str = DEFAULT_CONFIG["SOURCE_FOLDER"],
     output_folder: str = DEFAULT_CONFIG["OUTPUT_FOLDER"],
     delete_original: bool = DEFAULT_CONFIG["DELETE_ORIGINAL"],
-    libreoffice_path: str = DEFAULT_CONFIG["LIBREOFFICE_PATH"]
+    libreoffice_path: str = DEFAULT_CONFIG["LIBREOFFICE_PATH"],
+    backend: str = None,
+    pandoc_server: str = None,
+    start_pandoc_server: bool = False
 ):
+    """转换文件夹中的所有 docx
+
+    backend: 转换后端名称（见 backends.py），默认直接使用 LibreOffice
+    pandoc_server / start_pandoc_server: 连接已运行的 pandoc server，或在本地启动一个（pandoc、auto 后端）
+    """
     if not os.path.exists(source_folder):
         logging.error(f"源文件夹不存在: {source_folder}")
         return
@@ -211,14 +238,26 @@ def Cmain(
     print(f"开始处理 {len(docx_files)} 个 docx 文件...")
     success_count = 0
     
-    for file in docx_files:
-        if convert_docx_to_epub(
-            file,
-            output_folder=output_folder,
-            delete_original=delete_original,
-            libreoffice_path=libreoffice_path
-        ):
-            success_count += 1
+    if backend is None:
+        for file in docx_files:
+            if convert_docx_to_epub(
+                file,
+                output_folder=output_folder,
+                delete_original=delete_original,
+                libreoffice_path=libreoffice_path
+            ):
+                success_count += 1
+    else:
+        # backends 依赖本模块，这里延迟导入避免循环引用
+        from backends import get_backend
+        with get_backend(backend, libreoffice_path=libreoffice_path,
+                         pandoc_server=pandoc_server, start_server=start_pandoc_server) as converter:
+            for file in docx_files:
+                if converter.convert(file, output_folder):
+                    success_count += 1
+                    if delete_original:
+                        os.remove(file)
+                        logging.info(f"已删除原文件: {file}")
     
     print(f"\n处理完成！成功转换 {success_count}/{len(docx_files)} 个文件")
     print(f"详细日志见: {os.path.abspath('docx_conversion.log')}")
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+EPUB 打包工具
+所有生成或重新打包 epub 的地方都通过这里写出压缩包：
+
+- 各条目在线程池中并行压缩（zlib 压缩时会释放 GIL，可以用满多个核心）
+- jpg/png 等本身已压缩的媒体文件直接存储，不再重复 deflate
+- 按 EPUB 规范，mimetype 始终是第一个条目且不压缩
+"""
+
+import os
+import time
+import zlib
+import struct
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# 默认配置
+EPUB_WRITER_CONFIG = {
+    "COMPRESS_LEVEL": 6,                # deflate 压缩级别 0-9，0 表示全部直接存储
+    "MAX_WORKERS": os.cpu_count() or 1  # 并行压缩的线程数
+}
+
+# 已经压缩过的文件类型，deflate 基本没有收益
+STORED_EXTENSIONS = {
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".m4a",
+    ".ogg", ".woff", ".woff2", ".zip", ".epub", ".gz"
+}
+
+EPUB_MIMETYPE = b"application/epub+zip"
+
+_ZIP_STORED = 0
+_ZIP_DEFLATED = 8
+_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+_CENTRAL_HEADER = struct.Struct("<4s4B4HL2L5H2L")
+_END_RECORD = struct.Struct("<4s4H2LH")
+_ZIP32_LIMIT = 0xFFFFFFFF
+
+
+def _dos_datetime(timestamp):
+    t = time.localtime(timestamp)
+    year = max(t.tm_year, 1980)
+    dos_date = (year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dos_time = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+    return dos_time, dos_date
+
+
+def _compress_entry(arcname, source, level):
+    """读取并压缩单个条目，在线程池中执行
+
+    :param source: bytes 内容、磁盘文件路径，或返回 bytes 的函数（按需读取）
+    :return: (arcname, 压缩方式, crc, 压缩后数据, 原始大小, 修改时间)
+    """
+    if callable(source):
+        source = source()
+    if isinstance(source, (bytes, bytearray)):
+        data = bytes(source)
+        mtime = time.time()
+    else:
+        with open(source, "rb") as f:
+            data = f.read()
+        mtime = os.path.getmtime(source)
+
+    crc = zlib.crc32(data)
+    ext = os.path.splitext(arcname)[1].lower()
+    if level > 0 and arcname != "mimetype" and ext not in STORED_EXTENSIONS:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        # 压缩后反而变大的内容直接存储
+        if len(compressed) < len(data):
+            return arcname, _ZIP_DEFLATED, crc, compressed, len(data), mtime
+    return arcname, _ZIP_STORED, crc, data, len(data), mtime
+
+
+def _ordered_entries(entries):
+    """把 mimetype 放到第一位，没有的话补上"""
+    entries = [(arcname.replace(os.sep, "/"), source) for arcname, source in entries]
+    mimetype = [e for e in entries if e[0] == "mimetype"]
+    others = [e for e in entries if e[0] != "mimetype"]
+    return (mimetype[:1] or [("mimetype", EPUB_MIMETYPE)]) + others
+
+
+def _write_archive(fp, entries, level, max_workers):
+    central = []
+    offset = 0
+
+    def write_entry(result):
+        nonlocal offset
+        arcname, method, crc, data, size, mtime = result
+        name = arcname.encode("utf-8")
+        flags = 0x800 if not arcname.isascii() else 0
+        dos_time, dos_date = _dos_datetime(mtime)
+        if offset > _ZIP32_LIMIT or size > _ZIP32_LIMIT or len(data) > _ZIP32_LIMIT:
+            raise ValueError(f"epub 超出 zip 格式 4GB 限制: {arcname}")
+        fp.write(_LOCAL_HEADER.pack(
+            b"PK\x03\x04", 20, 0, flags, method, dos_time, dos_date,
+            crc, len(data), size, len(name), 0
+        ))
+        fp.write(name)
+        fp.write(data)
+        central.append(_CENTRAL_HEADER.pack(
+            b"PK\x01\x02", 20, 3, 20, 0, flags, method, dos_time, dos_date,
+            crc, len(data), size, len(name), 0, 0, 0, 0, 0o100644 << 16, offset
+        ) + name)
+        offset += _LOCAL_HEADER.size + len(name) + len(data)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # 只保留有限个进行中的任务，避免把整本书一次性读入内存
+        pending = deque()
+        for arcname, source in entries:
+            pending.append(pool.submit(_compress_entry, arcname, source, level))
+            if len(pending) >= max_workers * 2:
+                write_entry(pending.popleft().result())
+        while pending:
+            write_entry(pending.popleft().result())
+
+    if len(central) > 0xFFFF:
+        raise ValueError(f"epub 条目数超出 zip 格式限制: {len(central)}")
+    central_offset = offset
+    central_data = b"".join(central)
+    fp.write(central_data)
+    fp.write(_END_RECORD.pack(
+        b"PK\x05\x06", 0, 0, len(central), len(central),
+        len(central_data), central_offset, 0
+    ))
+
+
+def write_epub(entries, output, compresslevel=None, max_workers=None):
+    """把条目写成 epub 压缩包
+
+    :param entries: (压缩包内路径, bytes 内容、磁盘文件路径或返回 bytes 的函数) 的列表，顺序即写入顺序
+    :param output: 输出文件路径，或可写的二进制文件对象
+    :param compresslevel: deflate 压缩级别，默认取 EPUB_WRITER_CONFIG["COMPRESS_LEVEL"]
+    :param max_workers: 压缩线程数，默认取 EPUB_WRITER_CONFIG["MAX_WORKERS"]
+    """
+    level = EPUB_WRITER_CONFIG["COMPRESS_LEVEL"] if compresslevel is None else compresslevel
+    workers = max_workers or EPUB_WRITER_CONFIG["MAX_WORKERS"]
+    entries = _ordered_entries(entries)
+
+    if hasattr(output, "write"):
+        _write_archive(output, entries, level, workers)
+        return
+
+    # 先写到同目录下的临时文件再替换，避免覆盖原文件时中途失败留下损坏的 epub
+    output_dir = os.path.dirname(os.path.abspath(output))
+    fd, temp_path = tempfile.mkstemp(suffix=".epub.tmp", dir=output_dir)
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            _write_archive(fp, entries, level, workers)
+        os.replace(temp_path, output)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
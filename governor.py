@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+子进程内存准入控制
+LibreOffice、Pandoc、Calibre 处理大页面时单个进程就可能占用数 GB 内存，
+同时启动太多就会把机器拖进 swap 甚至触发 OOM。转换和合并阶段启动子进程前都要经过这里：
+
+- 按输入大小和历史上观察到的峰值 RSS 估算每个任务的内存
+- 后台线程定期采样运行中子进程（含其所有后代进程）的 RSS
+- 只有预计总用量不超过内存预算、且不超过系统当前可用内存时才放行新任务，否则等待
+
+RSS 在 Linux 上直接读 /proc，安装了 psutil 时使用 psutil（其他平台）。
+同一台机器上的多个进程各自有独立的调度器，需要各自只使用总预算的一部分
+（workqueue 的本地 worker 会平分预算，见 configure()），系统可用内存（MemAvailable）检查只是额外的保护。
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+MB = 1024 * 1024
+
+# 默认配置
+GOVERNOR_CONFIG = {
+    "MEMORY_BUDGET": None,          # 子进程总内存预算（字节），None 表示物理内存的 BUDGET_FRACTION
+    "BUDGET_FRACTION": 0.75,
+    "RESERVE": 512 * MB,            # 系统可用内存中始终保留的余量
+    "SAMPLE_INTERVAL": 0.5,         # RSS 采样间隔（秒）
+    "HISTORY_FILE": "rss_history.json",
+    "MAX_SAMPLES": 50,              # 每类任务保留的历史样本数
+    "SAFETY_FACTOR": 1.2,           # 历史估算的放大系数
+    "MIN_FIT_SIZE": 256 * 1024,     # 小于该输入大小的样本不参与每字节系数的拟合（启动开销占主导）
+    "MAX_RATIO": 200                # 每字节输入对应内存的上限
+}
+
+# 没有历史样本时的估算：(基础内存, 每字节输入对应的内存)
+DEFAULT_ESTIMATES = {
+    "libreoffice": (400 * MB, 30),
+    "pandoc": (200 * MB, 20),
+    "calibre": (300 * MB, 3)
+}
+
+
+def _meminfo():
+    """返回 (物理内存, 可用内存) 字节数，无法获取时为 None"""
+    if psutil is not None:
+        mem = psutil.virtual_memory()
+        return mem.total, mem.available
+    try:
+        values = {}
+        with open("/proc/meminfo") as f:
+            for line in f:
+                name, value = line.split(":", 1)
+                values[name] = int(value.split()[0]) * 1024
+        return values.get("MemTotal"), values.get("MemAvailable")
+    except (OSError, ValueError):
+        return None, None
+
+
+def default_memory_budget():
+    """GOVERNOR_CONFIG 中的内存预算，未设置时为物理内存的 BUDGET_FRACTION，无法获取时为 None"""
+    if GOVERNOR_CONFIG["MEMORY_BUDGET"] is not None:
+        return GOVERNOR_CONFIG["MEMORY_BUDGET"]
+    total, _ = _meminfo()
+    return int(total * GOVERNOR_CONFIG["BUDGET_FRACTION"]) if total else None
+
+
+def _proc_children():
+    """{父进程 pid: [子进程 pid]}，读取 /proc/<pid>/stat"""
+    children = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # comm 字段可能包含空格，从最后一个右括号之后解析
+        ppid = int(stat[stat.rfind(")") + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+    return children
+
+
+def process_tree_rss(pid):
+    """pid 及其所有后代进程的 RSS 之和（字节），进程已退出时返回 0"""
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            procs = [process] + process.children(recursive=True)
+        except psutil.Error:
+            return 0
+        total = 0
+        for p in procs:
+            try:
+                total += p.memory_info().rss
+            except psutil.Error:
+                pass
+        return total
+
+    if not os.path.isdir("/proc"):
+        return 0
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    children = _proc_children()
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            with open(f"/proc/{current}/statm") as f:
+                total += int(f.read().split()[1]) * page_size
+        except (OSError, ValueError, IndexError):
+            continue
+        stack.extend(children.get(current, []))
+    return total
+
+
+class _Job:
+    def __init__(self, kind, input_size, estimate):
+        self.kind = kind
+        self.input_size = input_size
+        self.estimate = estimate
+        self.pid = None
+        self.rss = 0
+        self.peak = 0
+
+    def projected(self):
+        # RSS 还在增长，按估算值和实际值中较大的计
+        return max(self.estimate, self.rss)
+
+
+class ResourceGovernor:
+    """子进程内存准入控制，线程安全"""
+
+    def __init__(self, memory_budget=None, reserve=None, history_file=None, sample_interval=None):
+        if memory_budget is None:
+            memory_budget = default_memory_budget()
+        if memory_budget is None:
+            logging.warning("无法获取物理内存大小，子进程内存准入控制只按历史估算排队")
+        self.memory_budget = memory_budget
+        self.reserve = GOVERNOR_CONFIG["RESERVE"] if reserve is None else reserve
+        self.history_file = history_file or GOVERNOR_CONFIG["HISTORY_FILE"]
+        self.sample_interval = sample_interval or GOVERNOR_CONFIG["SAMPLE_INTERVAL"]
+
+        self._cond = threading.Condition()
+        self._jobs = set()
+        self._monitor = None
+        self.history = self._load_history()
+
+    # 历史记录
+
+    def _load_history(self):
+        if not os.path.exists(self.history_file):
+            return {}
+        try:
+            with open(self.history_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logging.warning(f"无法读取 RSS 历史记录: {self.history_file}")
+            return {}
+
+    def _record(self, kind, input_size, peak):
+        """记录一次观察到的峰值 RSS；先合并文件中其他进程写入的样本再保存"""
+        history = self._load_history()
+        samples = history.setdefault(kind, []) + [[input_size, peak]]
+        history[kind] = samples[-GOVERNOR_CONFIG["MAX_SAMPLES"]:]
+        self.history = history
+        directory = os.path.dirname(os.path.abspath(self.history_file))
+        try:
+            fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(history, f)
+            os.replace(temp_path, self.history_file)
+        except OSError as e:
+            logging.warning(f"无法保存 RSS 历史记录: {e}")
+
+    def estimate(self, kind, input_size=0):
+        """估算任务的峰值内存
+
+        有历史样本时：基础内存取观察到的最小峰值；每字节系数用输入不小于 MIN_FIT_SIZE 的样本
+        对 (峰值-基础) 做过原点的最小二乘拟合，并限制在 MAX_RATIO 以内，
+        这样小页面上的启动开销波动不会被放大到大页面上。结果再乘以 SAFETY_FACTOR。
+        没有样本时使用 DEFAULT_ESTIMATES，没有足够大的样本时使用其中的每字节系数。
+        """
+        default_base, default_ratio = DEFAULT_ESTIMATES.get(kind, (500 * MB, 10))
+        samples = self.history.get(kind)
+        if not samples:
+            return int(default_base + default_ratio * input_size)
+        base = min(peak for _, peak in samples)
+        fit = [(size, peak - base) for size, peak in samples if size >= GOVERNOR_CONFIG["MIN_FIT_SIZE"]]
+        if fit:
+            ratio = sum(size * extra for size, extra in fit) / sum(size * size for size, _ in fit)
+        else:
+            ratio = default_ratio
+        ratio = min(max(ratio, 0), GOVERNOR_CONFIG["MAX_RATIO"])
+        return int((base + ratio * input_size) * GOVERNOR_CONFIG["SAFETY_FACTOR"])
+
+    # 准入
+
+    def _fits(self, estimate):
+        running = sum(job.projected() for job in self._jobs)
+        if self.memory_budget is not None and running + estimate > self.memory_budget:
+            return False
+        _, available = _meminfo()
+        if available is not None:
+            # 运行中的任务已占用的内存已经不在 MemAvailable 中，只需扣除它们还可能增长的部分
+            growth = sum(max(0, job.estimate - job.rss) for job in self._jobs)
+            if estimate + growth > available - self.reserve:
+                return False
+        return True
+
+    def acquire(self, kind, input_size=0):
+        """等待直到预计内存用量允许启动新任务；没有运行中的任务时总是放行，避免超大任务永远等待"""
+        job = _Job(kind, input_size, self.estimate(kind, input_size))
+        with self._cond:
+            waited = False
+            while self._jobs and not self._fits(job.estimate):
+                if not waited:
+                    logging.info(f"内存不足，{kind} 任务排队（预计 {job.estimate // MB} MB，"
+                                 f"运行中 {len(self._jobs)} 个）")
+                    waited = True
+                self._cond.wait(self.sample_interval)
+            if not self._jobs and not self._fits(job.estimate):
+                logging.warning(f"{kind} 任务预计需要 {job.estimate // MB} MB，超出内存预算，单独运行")
+            self._jobs.add(job)
+        return job
+
+    def release(self, job):
+        with self._cond:
+            self._jobs.discard(job)
+            self._cond.notify_all()
+        if job.peak > 0:
+            self._record(job.kind, job.input_size, job.peak)
+
+    def _start_monitor(self):
+        with self._cond:
+            if self._monitor is None or not self._monitor.is_alive():
+                self._monitor = threading.Thread(target=self._monitor_loop, daemon=True)
+                self._monitor.start()
+
+    def _monitor_loop(self):
+        while True:
+            with self._cond:
+                jobs = [job for job in self._jobs if job.pid is not None]
+                if not self._jobs:
+                    self._monitor = None
+                    return
+            for job in jobs:
+                job.rss = process_tree_rss(job.pid)
+                job.peak = max(job.peak, job.rss)
+            with self._cond:
+                self._cond.notify_all()
+            time.sleep(self.sample_interval)
+
+    def status(self):
+        with self._cond:
+            return {
+                "budget": self.memory_budget,
+                "running": len(self._jobs),
+                "projected": sum(job.projected() for job in self._jobs),
+                "rss": sum(job.rss for job in self._jobs)
+            }
+
+    # 子进程
+
+    def run(self, kind, command, input_size=0, check=False, **popen_kwargs):
+        """经准入控制后运行子进程，用法与 subprocess.run 相同
+
+        :param kind: 任务类别（libreoffice / pandoc / calibre），用于估算和历史记录
+        :param input_size: 输入大小（字节）
+        """
+        if popen_kwargs.pop("capture_output", False):
+            popen_kwargs["stdout"] = popen_kwargs["stderr"] = subprocess.PIPE
+        job = self.acquire(kind, input_size)
+        try:
+            process = subprocess.Popen(command, **popen_kwargs)
+            job.pid = process.pid
+            self._start_monitor()
+            try:
+                stdout, stderr = process.communicate()
+            except BaseException:
+                process.kill()
+                process.wait()
+                raise
+            # 很快结束的进程可能一次都没有被采样到
+            job.peak = max(job.peak, job.rss)
+        finally:
+            self.release(job)
+
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command, stdout, stderr)
+        return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def get_governor():
+    """进程内共享的调度器"""
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = ResourceGovernor()
+        return _governor
+
+
+def configure(**options):
+    """用给定参数（见 ResourceGovernor）替换进程内共享的调度器
+
+    同一台机器上的多个进程各自有独立的调度器，应各自只使用总预算的一部分，
+    例如 workqueue.run_local_workers 给每个 worker 分配 预算/worker 数。
+    """
+    global _governor
+    with _governor_lock:
+        _governor = ResourceGovernor(**options)
+        return _governor
+
+
+def run(kind, command, input_size=0, check=False, **popen_kwargs):
+    """通过共享调度器运行子进程，见 ResourceGovernor.run"""
+    return get_governor().run(kind, command, input_size=input_size, check=check, **popen_kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="查看子进程内存预算和各类任务的内存估算")
+    parser.add_argument("--size", type=float, default=1.0, help="估算用的输入大小（MB）")
+    args = parser.parse_args()
+
+    governor = get_governor()
+    total, available = _meminfo()
+    budget = governor.memory_budget
+    print(f"物理内存: {total // MB if total else '未知'} MB，可用: {available // MB if available else '未知'} MB")
+    print(f"内存预算: {budget // MB if budget else '不限'} MB，保留: {governor.reserve // MB} MB")
+    for kind in DEFAULT_ESTIMATES:
+        samples = len(governor.history.get(kind, []))
+        estimate = governor.estimate(kind, int(args.size * MB))
+        print(f"{kind}: 输入 {args.size} MB 预计 {estimate // MB} MB（{samples} 个历史样本）")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
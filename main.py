@@ -1,10 +1,32 @@
-from coreConver import Cmain
-from merger import merge_epub_folder
-import os,re,zipfile,tempfile
+from workqueue import publish_jobs, run_local_workers
+from backends import BACKEND_CONFIG, get_backend
+from epub_writer import write_epub
+from bundle import hierarchy_of
+from storage import IntermediateStore
+from pipeline import convert_folder, merge_book, page_keys, page_suffix
+import os,re,io,zipfile
 from pathlib import Path
 import logging,shutil
 from datetime import datetime
 from tqdm import tqdm
+# 中间格式："epub" 为单页 epub + Calibre EpubMerge 合并，"bundle" 为章节包（见 bundle.py）
+INTERMEDIATE_FORMAT = "epub"
+# 转换后端（见 backends.py）："libreoffice"、"pandoc" 或按校准结果选择的 "auto"
+BACKEND = BACKEND_CONFIG["DEFAULT_BACKEND"]
+# pandoc / auto 后端：连接已运行的 pandoc server 地址，或设置 START_PANDOC_SERVER 在本地启动一个，
+# 避免每个文件都启动一次 pandoc
+PANDOC_SERVER = None
+START_PANDOC_SERVER = False
+# 中间产物在 storage.IntermediateStore 中的键前缀
+INTERN_PREFIX = "internEpubs"
+FINAL_PREFIX = "finalEpubs"
+# 工作队列模式（见 workqueue.py）：设置为共享存储上的队列文件路径后，转换任务通过队列分发，
+# 其他主机可以运行 `python workqueue.py <QUEUE_PATH> worker` 一起转换。
+# 中间产物写到 QUEUE_SHARED_ROOT（默认为队列文件旁的 onenote2epub_store），它同样需要位于共享存储上
+QUEUE_PATH = None
+QUEUE_SHARED_ROOT = None
+QUEUE_WORKERS = os.cpu_count()
+
 def setup_logger():
     log_dir = Path("logs")
     log_dir.mkdir(exist_ok=True)
@@ -15,116 +37,112 @@ def setup_logger():
         format="%(asctime)s - %(levelname)s - %(message)s"
     )
 
-def fix_unknown_titles(epub):
-    """ Fix 'Unknown Title' entries in EPUB toc.ncx files by extracting proper titles from content files
+def fix_unknown_titles_bytes(data):
+    """ Fix 'Unknown Title' entries in the toc.ncx of an in-memory EPUB by extracting proper titles from content files
     Uses regex instead of XML libraries
 
+    Args:
+        data (bytes): EPUB file content
+    Returns:
+        tuple: (repackaged EPUB content, number of titles fixed)
+    """
+    with zipfile.ZipFile(io.BytesIO(data), 'r') as zip_ref:
+        entries = {name: zip_ref.read(name) for name in zip_ref.namelist() if not name.endswith('/')}
+    logging.info("Loaded EPUB entries into memory")
+
+    if 'toc.ncx' not in entries:
+        logging.warning("toc.ncx not found in EPUB")
+        return data, 0
+
+    toc_content = entries['toc.ncx'].decode('utf-8')
+    logging.info("Read toc.ncx content")
+
+    # Pattern to find navPoint blocks
+    nav_point_pattern = re.compile(r'<navPoint\s+[^>]*id="([^"]+)"[^>]*>.*?</navPoint>', re.DOTALL)
+    nav_points = nav_point_pattern.findall(toc_content)
+
+    fixed_count = 0
+
+    # For each navPoint, check if it contains "Unknown Title"
+    for nav_point_id in nav_points:
+        # Extract the complete navPoint block
+        nav_pattern = re.compile(r'(<navPoint\s+[^>]*id="' + re.escape(nav_point_id) +
+                                 r'"[^>]*>.*?</navPoint>)', re.DOTALL)
+        nav_match = nav_pattern.search(toc_content)
+
+        if nav_match:
+            nav_block = nav_match.group(1)
+
+            # Check if this block contains "Unknown Title"
+            text_pattern = re.compile(r'<text>Unknown Title</text>')
+            if text_pattern.search(nav_block):
+                # Extract the content src attribute
+                content_pattern = re.compile(r'<content\s+src="([^"]+)"')
+                content_match = content_pattern.search(nav_block)
+
+                if content_match:
+                    content_src = content_match.group(1)
+                    content_path = content_src.split('#')[0]
+
+                    try:
+                        # Read the content file
+                        content_data = entries[content_path].decode('utf-8')
+                        logging.info(f"Read content from {content_path}")
+
+                        # Extract the title
+                        title_pattern = re.compile(r'<title>([^<]+)</title>')
+                        title_match = title_pattern.search(content_data)
+
+                        if title_match:
+                            actual_title = title_match.group(1)
+
+                            # Replace "Unknown Title" with the actual title
+                            updated_nav_block = re.sub(
+                                r'<text>Unknown Title</text>',
+                                f'<text>{actual_title}</text>',
+                                nav_block
+                            )
+
+                            # Update the full content
+                            toc_content = toc_content.replace(nav_block, updated_nav_block)
+                            fixed_count += 1
+                            logging.info(f"Fixed: \"{actual_title}\" ({content_src})")
+                        else:
+                            logging.warning(f"No title found in {content_path}")
+                    except Exception as e:
+                        logging.error(f"Error processing content file {content_path}: {str(e)}")
+
+    if fixed_count == 0:
+        logging.info('No "Unknown Title" entries found in toc.ncx')
+        return data, 0
+
+    # 重新打包为 EPUB 文件
+    entries['toc.ncx'] = toc_content.encode('utf-8')
+    output = io.BytesIO()
+    write_epub(list(entries.items()), output)
+    logging.info(f"Updated toc.ncx with {fixed_count} fixed titles")
+    return output.getvalue(), fixed_count
+
+def fix_unknown_titles(epub):
+    """ Fix 'Unknown Title' entries in EPUB toc.ncx files, see fix_unknown_titles_bytes
+
     Args:
         epub (str): Path to the EPUB file
     Returns:
         int: Number of titles fixed
     """
-    temp_dir = tempfile.mkdtemp()
-    logging.info(f"Created temporary directory: {temp_dir}")
-    with zipfile.ZipFile(epub, 'r') as zip_ref:
-        zip_ref.extractall(temp_dir)
-        logging.info(f"Extracted EPUB to {temp_dir}")
-    epub_root = temp_dir
-    toc_path = os.path.join(epub_root, 'toc.ncx')
     try:
-        if not os.path.exists(toc_path):
-            logging.warning(f"toc.ncx not found in {epub}")
-            return 0
-
-        # Read the toc.ncx file
-        with open(toc_path, 'r', encoding='utf-8') as file:
-            toc_content = file.read()
-        logging.info(f"Read toc.ncx content from {toc_path}")
-
-        # Pattern to find navPoint blocks
-        nav_point_pattern = re.compile(r'<navPoint\s+[^>]*id="([^"]+)"[^>]*>.*?</navPoint>', re.DOTALL)
-        nav_points = nav_point_pattern.findall(toc_content)
-
-        fixed_count = 0
-
-        # For each navPoint, check if it contains "Unknown Title"
-        for nav_point_id in nav_points:
-            # Extract the complete navPoint block
-            nav_pattern = re.compile(r'(<navPoint\s+[^>]*id="' + re.escape(nav_point_id) +
-                                     r'"[^>]*>.*?</navPoint>)', re.DOTALL)
-            nav_match = nav_pattern.search(toc_content)
-
-            if nav_match:
-                nav_block = nav_match.group(1)
-
-                # Check if this block contains "Unknown Title"
-                text_pattern = re.compile(r'<text>Unknown Title</text>')
-                if text_pattern.search(nav_block):
-                    # Extract the content src attribute
-                    content_pattern = re.compile(r'<content\s+src="([^"]+)"')
-                    content_match = content_pattern.search(nav_block)
-
-                    if content_match:
-                        content_src = content_match.group(1)
-                        content_path = os.path.join(epub_root, content_src)
-
-                        try:
-                            # Read the content file
-                            with open(content_path, 'r', encoding='utf-8') as file:
-                                content_data = file.read()
-                            logging.info(f"Read content from {content_path}")
-
-                            # Extract the title
-                            title_pattern = re.compile(r'<title>([^<]+)</title>')
-                            title_match = title_pattern.search(content_data)
-
-                            if title_match:
-                                actual_title = title_match.group(1)
-
-                                # Replace "Unknown Title" with the actual title
-                                updated_nav_block = re.sub(
-                                    r'<text>Unknown Title</text>',
-                                    f'<text>{actual_title}</text>',
-                                    nav_block
-                                )
-
-                                # Update the full content
-                                toc_content = toc_content.replace(nav_block, updated_nav_block)
-                                fixed_count += 1
-                                logging.info(f"Fixed: \"{actual_title}\" ({content_src})")
-                            else:
-                                logging.warning(f"No title found in {content_path}")
-                        except Exception as e:
-                            logging.error(f"Error processing content file {content_path}: {str(e)}")
-
-        # Write the updated toc.ncx file if changes were made
+        with open(epub, 'rb') as f:
+            data = f.read()
+        data, fixed_count = fix_unknown_titles_bytes(data)
         if fixed_count > 0:
-            with open(toc_path, 'w', encoding='utf-8') as file:
-                file.write(toc_content)
-            logging.info(f"Updated toc.ncx with {fixed_count} fixed titles")
-        else:
-            logging.info('No "Unknown Title" entries found in toc.ncx')
-
-        # 重新打包为 EPUB 文件
-        file_path = epub
-        with zipfile.ZipFile(file_path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
-            for root, _, files in os.walk(temp_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, temp_dir)  # 获取相对路径
-                    zip_ref.write(file_path, arcname)
-        logging.info(f"Repackaged EPUB file: {file_path}")
-
+            with open(epub, 'wb') as f:
+                f.write(data)
+            logging.info(f"Repackaged EPUB file: {epub}")
         return fixed_count
-
     except Exception as e:
         logging.error(f"Error processing toc.ncx: {str(e)}")
         raise
-    finally:
-        # 删除临时文件夹
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-            logging.info(f"Deleted temporary directory: {temp_dir}")
 
 def delete_folder_contents(folder_path: str):
     """
@@ -183,34 +201,70 @@ def find_docx_folders(root_dir='.'):
     return docx_folders
 
 
-def ConvertFirst(docx_folders):
+def ConvertFirst(docx_folders, store, backend=BACKEND, intermediate=INTERMEDIATE_FORMAT, root_dir=None,
+                 pandoc_server=PANDOC_SERVER, start_pandoc_server=START_PANDOC_SERVER):
+    """转换各文件夹，中间产物写入 store 的 internEpubs/<分册名>/ 下，返回分册名列表"""
     EpubList = []
-    for folder in tqdm(docx_folders, desc="Converting folders"):
-        output_dir = os.path.join('','internEpubs',f'{Path(folder).name}')
-        logging.info(f"Converting {folder}...")
-        Cmain(source_folder=folder,output_folder=output_dir) 
-        EpubList.append(output_dir)
+    with get_backend(backend, pandoc_server=pandoc_server, start_server=start_pandoc_server) as converter:
+        for folder in tqdm(docx_folders, desc="Converting folders"):
+            book = Path(folder).name
+            logging.info(f"Converting {folder}...")
+            convert_folder(folder, f"{INTERN_PREFIX}/{book}", converter, store,
+                           intermediate, hierarchy_of(folder, root_dir))
+            EpubList.append(book)
     return EpubList
 
-def MergeEpub(EpubList):
-    for folder in tqdm(EpubList, desc="Merging EPUBs"):
-        logging.info(f"Merging {folder}...")
-        output = os.path.join('','finalEpubs',f'{Path(folder).name}.epub')
-        merge_epub_folder(folder,
-                         output=output,
-                         title=f'{Path(folder).name}',
-                         author='VIIII4258',
-                         sort="date_reverse"
-                         )
-    delete_folder_contents(os.path.join('','internEpubs'))
+def ConvertQueued(docx_folders, queue_path, store, workers=os.cpu_count(), intermediate=INTERMEDIATE_FORMAT,
+                  backend=BACKEND, pandoc_server=PANDOC_SERVER, start_pandoc_server=START_PANDOC_SERVER,
+                  root_dir=None):
+    """通过工作队列转换：发布任务后在本机启动 workers 个 worker 进程
+
+    worker 把结果直接写到 store.spill_dir 下，多机运行时 store 需要以共享存储上的目录作为 spill_dir
+    （见 QUEUE_SHARED_ROOT）。
+    其他主机可以同时运行 `python workqueue.py <queue_path> worker` 一起处理同一个队列
+    """
+    output_root = os.path.join(store.spill_dir, INTERN_PREFIX)
+    EpubList = [Path(folder).name for folder in publish_jobs(queue_path, docx_folders, output_root, root_dir)]
+    status = run_local_workers(queue_path, workers, intermediate=intermediate, backend=backend,
+                               pandoc_server=pandoc_server, start_pandoc_server=start_pandoc_server)
+    logging.info(f"Queue finished: {status}")
+    store.rescan()
+    return EpubList
+
+def MergeEpub(EpubList, store, intermediate=INTERMEDIATE_FORMAT):
+    """合并各分册到 store 的 finalEpubs/ 下并导出到 finalEpubs 文件夹
+
+    章节包模式下保留中间产物，合集直接由章节包生成
+    """
+    for book in tqdm(EpubList, desc="Merging EPUBs"):
+        logging.info(f"Merging {book}...")
+        output_key = f"{FINAL_PREFIX}/{book}.epub"
+        if merge_book(store,
+                      page_keys(store, f"{INTERN_PREFIX}/{book}", intermediate),
+                      output_key,
+                      title=book,
+                      author='VIIII4258',
+                      intermediate=intermediate,
+                      sort="date_reverse"
+                      ):
+            store.export(output_key, os.path.join('','finalEpubs',f'{book}.epub'))
+    if intermediate != "bundle":
+        for key in store.keys(f"{INTERN_PREFIX}/"):
+            store.delete(key)
 
 
 if __name__ == "__main__":
-    os.makedirs(os.path.join('','internEpubs'), exist_ok=True)
     os.makedirs(os.path.join('','finalEpubs'), exist_ok=True)
     setup_logger()
     delete_folder_contents(os.path.join('','finalEpubs'))
-    delete_folder_contents(os.path.join('','internEpubs'))
+    if QUEUE_PATH:
+        shared_root = QUEUE_SHARED_ROOT or os.path.join(os.path.dirname(os.path.abspath(QUEUE_PATH)), "onenote2epub_store")
+        store = IntermediateStore(spill_dir=shared_root)
+        # 共享目录会保留到下次运行，先清掉上次留下的中间产物
+        for key in store.keys():
+            store.delete(key)
+    else:
+        store = IntermediateStore()
     try:
         logging.info("Program started")
         root_dir = str(input("请输入项目根目录路径："))
@@ -220,30 +274,44 @@ if __name__ == "__main__":
         logging.info(f"Found {len(docx_folders)} folders with DOCX files")
         
         logging.info("Starting conversion...")
-        EpubList = ConvertFirst(docx_folders)
+        if QUEUE_PATH:
+            EpubList = ConvertQueued(docx_folders, QUEUE_PATH, store, QUEUE_WORKERS, root_dir=root_dir)
+        else:
+            EpubList = ConvertFirst(docx_folders, store, root_dir=root_dir)
         
         logging.info("Merging EPUB files...")
-        MergeEpub(EpubList)
+        MergeEpub(EpubList, store)
         
         logging.info("Process completed successfully,see finalEpubs for result")
         key = input("想要继续将这些书（onenote所有笔记)合成一本吗？(~~有概率死机~~）(y/n)")
         if key == 'y' or key == 'Y':
             shuming = input("请输入书名")
             zuozhe = input("请输入作者")
-            merge_epub_folder(os.path.join('','finalEpubs'),
-                         output=os.path.join('',f'{shuming}.epub'),
-                         title=str(shuming),
-                         author=str(zuozhe),
-                         sort="date_reverse"
-                         )
-            fix_unknown_titles(os.path.join('',f'{shuming}.epub'))
+            output_key = f'{shuming}.epub'
+            if INTERMEDIATE_FORMAT == "bundle":
+                # 章节包带有完整的层级路径，直接生成合集，目录按 笔记本/分区 分组
+                merge_book(store,
+                           [k for k in store.keys(f"{INTERN_PREFIX}/") if k.endswith(page_suffix("bundle"))],
+                           output_key,
+                           title=str(shuming),
+                           author=str(zuozhe),
+                           intermediate="bundle"
+                           )
+            else:
+                merge_book(store,
+                           store.keys(f"{FINAL_PREFIX}/"),
+                           output_key,
+                           title=str(shuming),
+                           author=str(zuozhe),
+                           sort="date_reverse"
+                           )
+                data, _ = fix_unknown_titles_bytes(store.get(output_key))
+                store.put(output_key, data)
+            store.export(output_key, os.path.join('',f'{shuming}.epub'))
             delete_folder_contents(os.path.join('','finalEpubs'))
             logging.info("Process completed successfully,see this root for result")
     except Exception as e:
         logging.error(f"Error occurred: {str(e)}", exc_info=True)
         raise
-    
-
-
-
-    
\ No newline at end of file
+    finally:
+        store.close()
@@ -3,6 +3,9 @@
 """
 Calibre EpubMerge自动化脚本
 用于合并指定文件夹内的所有epub文件
+
+输入较多时使用树形合并（见 tree_merge_epub_files）：每 CHUNK_SIZE 个输入由一个 calibre-debug 进程合并，
+多个进程并行执行，再逐层合并中间结果，单个进程的内存占用和命令行长度都有上限。
 """
 
 import os
@@ -10,7 +13,19 @@ import subprocess
 import argparse
 import glob
 import shutil
+import tempfile
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import governor
+
+# 树形合并配置
+MERGE_CONFIG = {
+    "CHUNK_SIZE": 100,                  # 每个 calibre-debug 进程最多合并的输入数，0 表示不分块、一次合并全部
+    "MAX_WORKERS": os.cpu_count() or 1, # 同一层中同时运行的 calibre-debug 进程数
+    "WORK_DIR": None                    # 中间结果所在的磁盘目录，None 表示系统临时目录；
+                                        # 不要设置为 tmpfs，否则中间结果会占用内存且不受内存准入控制约束
+}
 
 
 def find_epub_files(folder_path):
@@ -77,7 +92,9 @@ def merge_epub_files(epub_files, output_file, calibre_path="calibre-debug", titl
     try:
         print("\n执行合并命令...")
         print(' '.join(cmd))
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        # 经内存准入控制后启动 calibre-debug，树形合并时并行的进程数也受其限制（见 governor.py）
+        input_size = sum(os.path.getsize(f) for f in epub_files)
+        result = governor.run("calibre", cmd, input_size=input_size, check=True, capture_output=True, text=True)
         print("合并成功!")
         print(f"输出文件: {output_file}")
         return True
@@ -89,6 +106,68 @@ def merge_epub_files(epub_files, output_file, calibre_path="calibre-debug", titl
         return False
 
 
+def tree_merge_epub_files(epub_files, output_file, calibre_path="calibre-debug", title=None, author=None,
+                          description=None, tags=None, cover_img=None, titles_nav_points=None,
+                          nav_points_insert=None, source_nav_rule=None, chunk_size=None, workers=None,
+                          work_dir=None):
+    """分层并行合并epub文件，参数与 merge_epub_files 相同
+
+    每 chunk_size 个输入合并为一个中间 epub（同一层最多 workers 个 calibre-debug 进程并行），
+    再逐层合并中间结果，直到不超过 chunk_size 个时合并为最终输出。
+
+    - 每一层都按原顺序分块、按原顺序合并，章节顺序与一次性合并相同
+    - 第一层使用调用方的导航点设置，之后各层不再为中间 epub 插入导航点，只保留其目录，
+      因此最终目录与一次性合并时的层级相同，不会多出一层"分块"
+    - 书名、作者、封面等元数据只用于最终输出
+    - 中间结果写在 work_dir（默认 MERGE_CONFIG["WORK_DIR"]）中，合并完成后删除
+    - 输入不超过 chunk_size（或 chunk_size 为 0）时直接调用 merge_epub_files
+    """
+    chunk_size = MERGE_CONFIG["CHUNK_SIZE"] if chunk_size is None else chunk_size
+    workers = workers or MERGE_CONFIG["MAX_WORKERS"]
+    if chunk_size == 1:
+        raise ValueError("chunk_size 至少为 2")
+
+    final_options = dict(
+        calibre_path=calibre_path, title=title, author=author, description=description,
+        tags=tags, cover_img=cover_img, source_nav_rule=source_nav_rule
+    )
+    nav_options = dict(titles_nav_points=titles_nav_points, nav_points_insert=nav_points_insert)
+    if not chunk_size or len(epub_files) <= chunk_size:
+        return merge_epub_files(epub_files, output_file, **nav_options, **final_options)
+
+    # 中间结果放在磁盘上的工作目录中（输出文件可能位于 tmpfs），最后整体删除
+    work_dir = tempfile.mkdtemp(prefix="epubmerge_", dir=work_dir or MERGE_CONFIG["WORK_DIR"])
+    try:
+        current = list(epub_files)
+        level = 0
+        while len(current) > chunk_size:
+            level += 1
+            chunks = [current[i:i + chunk_size] for i in range(0, len(current), chunk_size)]
+            print(f"\n树形合并第 {level} 层: {len(current)} 个输入 -> {len(chunks)} 个中间 epub")
+
+            def merge_chunk(index, chunk, level=level, nav_options=nav_options):
+                # 第一层之后的单个中间结果不需要再合并一次
+                if level > 1 and len(chunk) == 1:
+                    return chunk[0]
+                output = os.path.join(work_dir, f"level{level}_{index:05d}.epub")
+                ok = merge_epub_files(
+                    chunk, output, calibre_path=calibre_path,
+                    title=f"{title or 'merged'} {level}-{index + 1}", author=author,
+                    source_nav_rule=source_nav_rule, **nav_options
+                )
+                return output if ok else None
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(merge_chunk, range(len(chunks)), chunks))
+            if None in results:
+                print(f"树形合并第 {level} 层失败")
+                return False
+            current = results
+            nav_options = dict(titles_nav_points=0, nav_points_insert=0)
+
+        return merge_epub_files(current, output_file, **nav_options, **final_options)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
 
 
 def merge_epub_folder(
@@ -103,7 +182,10 @@ def merge_epub_folder(
     nav_points_insert=None,
     source_nav_rule=None,
     calibre_path="calibre-debug",
-    sort="name"
+    sort="name",
+    chunk_size=None,
+    workers=None,
+    work_dir=None
 ):
     
     
@@ -144,8 +226,8 @@ def merge_epub_folder(
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    # 调用核心合并函数
-    return merge_epub_files(
+    # 调用核心合并函数（输入较多时分层并行合并）
+    return tree_merge_epub_files(
         epub_files=epub_files,
         output_file=output,
         calibre_path=calibre_path,
@@ -156,7 +238,10 @@ def merge_epub_folder(
         cover_img=cover_img,
         titles_nav_points=titles_nav_points,
         nav_points_insert=nav_points_insert,
-        source_nav_rule=source_nav_rule
+        source_nav_rule=source_nav_rule,
+        chunk_size=chunk_size,
+        workers=workers,
+        work_dir=work_dir
     )
 
 
@@ -181,6 +266,12 @@ def main():
     parser.add_argument("--calibre-path", help="calibre-debug的路径", default="calibre-debug")
     parser.add_argument("--sort", choices=["name", "name_reverse", "size", "size_reverse", "date", "date_reverse"],
                         help="文件排序方式", default="name")
+    parser.add_argument("-k", "--chunk-size", type=int, default=MERGE_CONFIG["CHUNK_SIZE"],
+                        help="树形合并时每个进程合并的输入数 (0=一次合并全部)")
+    parser.add_argument("-w", "--workers", type=int, default=MERGE_CONFIG["MAX_WORKERS"],
+                        help="并行的 calibre-debug 进程数")
+    parser.add_argument("--work-dir", default=MERGE_CONFIG["WORK_DIR"],
+                        help="树形合并中间结果所在的磁盘目录，默认为系统临时目录")
     args = parser.parse_args()
     
     # 确保文件夹存在
@@ -238,7 +329,10 @@ def main():
             nav_points_insert=args.nav_points_insert,
             source_nav_rule=args.source_nav_rule,
             calibre_path=args.calibre_path,
-            sort=args.sort
+            sort=args.sort,
+            chunk_size=args.chunk_size,
+            workers=args.workers,
+            work_dir=args.work_dir
         )
         return 0 if success else 1
     except Exception as e:
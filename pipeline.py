@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+流水线各阶段
+转换和合并阶段都通过 storage.IntermediateStore 读写中间产物，不再使用写死的相对目录。
+键由调用方决定，main.py 使用 "internEpubs/<分册>/<页面>.epub|.bundle" 和 "finalEpubs/<分册>.epub"。
+"""
+
+import io
+import os
+import logging
+
+from coreConver import get_docx_files, anlyze_epub_bytes
+from merger import tree_merge_epub_files
+from bundle import (BUNDLE_SUFFIX, hierarchy_of, epub_to_bundle_data, bundle_to_bytes,
+                    sort_bundles, build_epub_from_bundles)
+
+
+def page_suffix(intermediate="epub"):
+    return BUNDLE_SUFFIX if intermediate == "bundle" else ".epub"
+
+
+def page_key(prefix, docx, intermediate="epub"):
+    """docx 在存储中的键：<prefix>/<页面名><后缀>"""
+    name = os.path.splitext(os.path.basename(docx))[0] + page_suffix(intermediate)
+    return f"{prefix}/{name}" if prefix else name
+
+
+def page_keys(store, prefix, intermediate="epub"):
+    """prefix 下的所有页面键（不含更深层级）"""
+    prefix = f"{prefix}/" if prefix else ""
+    return [
+        k for k in store.keys(prefix)
+        if "/" not in k[len(prefix):] and k.endswith(page_suffix(intermediate))
+    ]
+
+
+def convert_page(docx, key, converter, store, intermediate="epub", hierarchy=None):
+    """转换单个页面并写入存储，返回键，失败返回 None
+
+    转换器在 store.scratch() 提供的临时目录（默认位于 tmpfs）中输出 epub，
+    标题修正或章节包生成都在内存中完成。
+
+    :param converter: 转换后端实例（见 backends.py）
+    :param intermediate: "epub" 保存修正标题后的单页 epub，"bundle" 保存章节包归档
+    """
+    name = os.path.splitext(os.path.basename(docx))[0]
+    try:
+        with store.scratch() as work:
+            if not converter.convert(docx, work):
+                return None
+            with open(os.path.join(work, name + ".epub"), "rb") as f:
+                data = f.read()
+
+        if intermediate == "bundle":
+            meta, files = epub_to_bundle_data(
+                data, name, source=docx,
+                hierarchy=hierarchy or hierarchy_of(os.path.dirname(docx))
+            )
+            data = bundle_to_bytes(meta, files)
+        else:
+            data = anlyze_epub_bytes(data)
+        store.put(key, data)
+    except Exception as e:
+        # 单个页面出错（转换结果损坏、缺少 OPF 等）只跳过该页面
+        logging.error(f"处理页面出错: {docx} - {str(e)}")
+        return None
+    return key
+
+
+def convert_folder(folder, prefix, converter, store, intermediate="epub", hierarchy=None):
+    """转换文件夹中的所有 docx 到存储的 prefix 下，返回成功转换的数量"""
+    docx_files = get_docx_files(folder)
+    print(f"开始处理 {len(docx_files)} 个 docx 文件...")
+    success_count = 0
+    for docx in docx_files:
+        if convert_page(docx, page_key(prefix, docx, intermediate), converter, store, intermediate, hierarchy):
+            success_count += 1
+    print(f"\n处理完成！成功转换 {success_count}/{len(docx_files)} 个文件")
+    return success_count
+
+
+def sort_keys(store, keys, sort="name"):
+    """与 merger.merge_epub_folder 的排序方式一致（size 按内容大小）"""
+    sort_options = {
+        "name": lambda k: os.path.basename(k).lower(),
+        "size": lambda k: len(store.get(k)),
+        "date": lambda k: store.mtime(k)
+    }
+    reverse = sort.endswith("_reverse")
+    return sorted(keys, key=sort_options[sort.replace("_reverse", "")], reverse=reverse)
+
+
+def merge_book(store, keys, output_key, title, author=None, intermediate="epub",
+               sort="name", calibre_path="calibre-debug", chunk_size=None, workers=None, work_dir=None):
+    """把一组页面合成一本书并写入存储的 output_key
+
+    章节包直接在内存中生成 epub；单页 epub 需要落地后交给 Calibre EpubMerge，
+    页面较多时分层并行合并（chunk_size、workers、work_dir 见 merger.tree_merge_epub_files），
+    最终输出写在 scratch() 中，中间结果写在磁盘上的 work_dir 中。
+    """
+    if not keys:
+        raise FileNotFoundError("没有找到可合并的页面")
+
+    if intermediate == "bundle":
+        bundles = sort_bundles([store.source(k) for k in keys])
+        output = io.BytesIO()
+        build_epub_from_bundles(bundles, output, title=title, author=author)
+        store.put(output_key, output.getvalue())
+        return True
+
+    # 页面临时落地到 tmpfs，不会把整本书写入（可能位于网络存储上的）spill_dir
+    with store.materialize(sort_keys(store, keys, sort)) as epub_files, store.scratch() as work:
+        output = os.path.join(work, os.path.basename(output_key))
+        if not tree_merge_epub_files(epub_files, output, calibre_path=calibre_path, title=title, author=author,
+                                     chunk_size=chunk_size, workers=workers, work_dir=work_dir):
+            return False
+        store.put_file(output_key, output)
+    logging.info(f"已合并 {len(keys)} 个页面: {output_key}")
+    return True
+
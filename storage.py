@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+中间产物存储
+流水线中的中间文件（单页 epub、章节包、分册）原来都写在相对目录里并被反复读取，
+在网络挂载的家目录上 I/O 就成了瓶颈。这里统一通过 IntermediateStore 读写：
+
+- 对象优先保存在内存中（或保存在可配置的 tmpfs 目录中），总量不超过内存预算
+- 超出预算后把最久未使用的对象溢出到磁盘（spill_dir）
+- LibreOffice、Calibre 等外部程序需要真实文件时，用 materialize() 临时落地（不写入 spill_dir），
+  用 scratch() 获取临时工作目录
+
+键使用 "/" 分隔的相对路径，例如 "分区名/003_页面.epub"，溢出后的文件位于 spill_dir 下的同名路径，
+因此给定一个持久的 spill_dir 时，flush() 之后的目录布局与原来的 internEpubs 相同，下次启动可以直接复用。
+"""
+
+import os
+import time
+import uuid
+import shutil
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# 默认配置
+STORAGE_CONFIG = {
+    "MEMORY_BUDGET": 512 * 1024 * 1024,     # 内存层的总字节数上限
+    "MEMORY_DIR": None,                     # 设置为 tmpfs 目录（如 /dev/shm/onenote2epub）时内存层保存为该目录下的文件
+    "WORK_DIR": "/dev/shm" if os.path.isdir("/dev/shm") else None  # 外部程序临时工作目录的位置
+}
+
+_TEMP_SUFFIX = ".tmp"
+
+
+def _is_temp(name):
+    return name.startswith(".") and name.endswith(_TEMP_SUFFIX)
+
+
+def _replace_into(path, fill, mtime=None):
+    """先由 fill(临时路径) 写出同目录下的临时文件，再用 os.replace 替换到 path
+
+    spill_dir 可能被多个 worker 共享，租约回收后两个 worker 可能同时写同一个键，
+    直接写目标路径会留下不完整的文件并被 rescan() 登记。临时文件以 "." 开头、".tmp" 结尾，rescan() 会跳过。
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = os.path.join(
+        os.path.dirname(path), f".{os.path.basename(path)}.{uuid.uuid4().hex}{_TEMP_SUFFIX}"
+    )
+    try:
+        fill(temp_path)
+        if mtime is not None:
+            os.utime(temp_path, (mtime, mtime))
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _write_bytes(data):
+    def fill(path):
+        with open(path, "wb") as f:
+            f.write(data)
+    return fill
+
+
+class IntermediateStore:
+    """带内存预算、按 LRU 溢出到磁盘的中间产物存储，线程安全"""
+
+    def __init__(self, spill_dir=None, memory_budget=None, memory_dir=None, work_dir=None):
+        """
+        :param spill_dir: 溢出目录；不指定时使用临时目录并在 close() 时删除。
+                          指定的目录中已有的文件会作为已溢出的对象加载
+        :param memory_budget: 内存层字节数上限，0 表示所有对象直接写入 spill_dir
+        :param memory_dir: 内存层使用的 tmpfs 目录，不指定时内存层保存为 bytes
+        :param work_dir: scratch() 临时工作目录的父目录
+        """
+        self.memory_budget = STORAGE_CONFIG["MEMORY_BUDGET"] if memory_budget is None else memory_budget
+        self.work_dir = work_dir or STORAGE_CONFIG["WORK_DIR"]
+        self._owns_spill_dir = spill_dir is None
+        self.spill_dir = os.path.abspath(spill_dir or tempfile.mkdtemp(prefix="onenote2epub_spill_"))
+        memory_dir = memory_dir or STORAGE_CONFIG["MEMORY_DIR"]
+        self.memory_dir = tempfile.mkdtemp(prefix="onenote2epub_mem_", dir=memory_dir) if memory_dir else None
+
+        self._lock = threading.RLock()
+        self._memory = OrderedDict()   # key -> (bytes 或 memory_dir 中的文件路径, 大小, 修改时间)
+        self._spilled = {}             # key -> 修改时间
+        self.memory_used = 0
+        os.makedirs(self.spill_dir, exist_ok=True)
+        self.rescan()
+
+    # 路径
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, *key.split("/"))
+
+    def _memory_path(self, key):
+        return os.path.join(self.memory_dir, *key.split("/"))
+
+    def rescan(self):
+        """把 spill_dir 中尚未登记的文件登记为已溢出对象（例如其他进程写入的结果）"""
+        with self._lock:
+            for root, _, files in os.walk(self.spill_dir):
+                for f in files:
+                    if _is_temp(f):
+                        continue
+                    path = os.path.join(root, f)
+                    key = os.path.relpath(path, self.spill_dir).replace(os.sep, "/")
+                    if key not in self._memory and key not in self._spilled:
+                        self._spilled[key] = os.path.getmtime(path)
+
+    # 内存层管理
+
+    def _drop_memory(self, key):
+        value, size, _ = self._memory.pop(key)
+        self.memory_used -= size
+        if self.memory_dir and os.path.exists(value):
+            os.remove(value)
+
+    def _spill(self, key):
+        """把内存中的对象写到 spill_dir"""
+        value, _, mtime = self._memory[key]
+        fill = (lambda temp: shutil.copyfile(value, temp)) if self.memory_dir else _write_bytes(value)
+        _replace_into(self._spill_path(key), fill, mtime)
+        self._drop_memory(key)
+        self._spilled[key] = mtime
+        logging.debug(f"中间产物溢出到磁盘: {key}")
+
+    def _evict(self):
+        while self.memory_used > self.memory_budget and self._memory:
+            self._spill(next(iter(self._memory)))
+
+    def _remove_spilled(self, key):
+        if self._spilled.pop(key, None) is not None:
+            path = self._spill_path(key)
+            if os.path.exists(path):
+                os.remove(path)
+
+    # 读写接口
+
+    def put(self, key, data):
+        """写入（覆盖）一个对象"""
+        with self._lock:
+            self.delete(key)
+            mtime = time.time()
+            if len(data) > self.memory_budget:
+                path = self._spill_path(key)
+                _replace_into(path, _write_bytes(data))
+                self._spilled[key] = os.path.getmtime(path)
+                return
+            if self.memory_dir:
+                value = self._memory_path(key)
+                os.makedirs(os.path.dirname(value), exist_ok=True)
+                with open(value, "wb") as f:
+                    f.write(data)
+            else:
+                value = bytes(data)
+            self._memory[key] = (value, len(data), mtime)
+            self.memory_used += len(data)
+            self._evict()
+
+    def put_file(self, key, path):
+        """把外部程序生成的文件收入存储，原文件会被移走"""
+        with self._lock:
+            size = os.path.getsize(path)
+            if size > self.memory_budget:
+                self.delete(key)
+                target = self._spill_path(key)
+                _replace_into(target, lambda temp: shutil.move(path, temp))
+                self._spilled[key] = os.path.getmtime(target)
+                return
+        with open(path, "rb") as f:
+            data = f.read()
+        os.remove(path)
+        self.put(key, data)
+
+    def get(self, key):
+        """读取对象内容；溢出的对象在预算允许时重新载入内存"""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                value = self._memory[key][0]
+                if not self.memory_dir:
+                    return value
+                with open(value, "rb") as f:
+                    return f.read()
+            if key not in self._spilled:
+                raise KeyError(key)
+            with open(self._spill_path(key), "rb") as f:
+                data = f.read()
+            if len(data) <= self.memory_budget:
+                mtime = self._spilled.pop(key)
+                os.remove(self._spill_path(key))
+                self.put(key, data)
+                self._memory[key] = self._memory[key][:2] + (mtime,)
+            return data
+
+    def source(self, key):
+        """返回对象内容（bytes 内存层）或文件路径（tmpfs 内存层或已溢出），不改变对象所在的层
+
+        用于一次性读取大量对象的场景（例如合并整本书），避免溢出的对象被逐个载回内存、挤出其他对象。
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key][0]
+            if key not in self._spilled:
+                raise KeyError(key)
+            return self._spill_path(key)
+
+    @contextmanager
+    def materialize(self, keys):
+        """以磁盘文件的形式临时提供一组对象，供需要真实文件的外部程序使用，返回路径列表
+
+        内存层的对象写到 scratch() 临时目录（默认位于 tmpfs，tmpfs 内存层直接硬链接）中，
+        退出时删除，对象本身仍留在内存层，不会写入 spill_dir；已溢出的对象直接返回其在 spill_dir 中的路径。
+        """
+        with self.scratch() as work:
+            paths = []
+            for key in keys:
+                with self._lock:
+                    if key in self._memory:
+                        self._memory.move_to_end(key)
+                        value = self._memory[key][0]
+                        path = os.path.join(work, *key.split("/"))
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        if not self.memory_dir:
+                            with open(path, "wb") as f:
+                                f.write(value)
+                        else:
+                            try:
+                                os.link(value, path)
+                            except OSError:
+                                shutil.copyfile(value, path)
+                    elif key in self._spilled:
+                        path = self._spill_path(key)
+                    else:
+                        raise KeyError(key)
+                paths.append(path)
+            yield paths
+
+    def mtime(self, key):
+        with self._lock:
+            if key in self._memory:
+                return self._memory[key][2]
+            if key in self._spilled:
+                return self._spilled[key]
+            raise KeyError(key)
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._drop_memory(key)
+            self._remove_spilled(key)
+
+    def keys(self, prefix=""):
+        """按键排序返回以 prefix 开头的键"""
+        with self._lock:
+            return sorted(k for k in list(self._memory) + list(self._spilled) if k.startswith(prefix))
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._memory or key in self._spilled
+
+    def export(self, key, destination):
+        """把对象写到最终输出位置"""
+        destination = os.path.abspath(destination)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with self._lock:
+            if key in self._spilled:
+                shutil.copyfile(self._spill_path(key), destination)
+                return destination
+            if key in self._memory and self.memory_dir:
+                shutil.copyfile(self._memory[key][0], destination)
+                return destination
+        with open(destination, "wb") as f:
+            f.write(self.get(key))
+        return destination
+
+    @contextmanager
+    def scratch(self):
+        """外部程序使用的临时工作目录（默认位于 tmpfs），退出时删除"""
+        path = tempfile.mkdtemp(prefix="onenote2epub_work_", dir=self.work_dir)
+        try:
+            yield path
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def flush(self):
+        """把内存层全部写到 spill_dir，使其在进程退出后仍然可用"""
+        with self._lock:
+            for key in list(self._memory):
+                self._spill(key)
+
+    def close(self):
+        with self._lock:
+            for key in list(self._memory):
+                self._drop_memory(key)
+        if self.memory_dir:
+            shutil.rmtree(self.memory_dir, ignore_errors=True)
+        if self._owns_spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+监视模式
+持续监视 OneNoteExport 根目录中 docx 的新增、修改和删除，
+变化停止一段时间（防抖）后只重新转换受影响的页面，只重建受影响的分册（以及可选的合集）。
+全程没有交互式输入，适合每天多次重新导出后自动更新。
+
+与 main.py 的批处理流程不同，中间产物和 finalEpubs 在监视期间会一直保留，
+它们就是增量重建所依赖的状态。中间产物保存在以 internEpubs 为溢出目录的 IntermediateStore 中
+（见 storage.py），退出时全部写回 internEpubs；启动时会用 docx 与已有中间产物的修改时间对比，
+只补做过期或缺失的页面。
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+from pathlib import Path
+
+from coreConver import DEFAULT_CONFIG
+from backends import BACKENDS, BACKEND_CONFIG, get_backend
+from merger import merge_epub_folder
+from bundle import hierarchy_of
+from storage import IntermediateStore
+from pipeline import convert_page, page_key, page_keys, page_suffix, merge_book
+from main import fix_unknown_titles, setup_logger
+
+# 默认配置
+WATCH_CONFIG = {
+    "INTERVAL": 2,                  # 扫描间隔（秒）
+    "DEBOUNCE": 10,                 # 目录连续这么多秒没有变化后才开始处理
+    "INTERN_FOLDER": "internEpubs",
+    "FINAL_FOLDER": "finalEpubs",
+    "AUTHOR": "VIIII4258",
+    "INTERMEDIATE": "epub"          # "epub" 或 "bundle"（见 bundle.py）
+}
+
+# 重新转换的页面修改时间会变，按 date_reverse 排序会打乱页面顺序；
+# onenote_to_docx 导出的文件名带有 000_ 形式的序号，按文件名排序即为页面顺序
+BOOK_SORT = "name"
+
+
+def snapshot(root_dir):
+    """返回 {docx 绝对路径: (修改时间, 大小)}，忽略 Word 的 ~$ 临时文件"""
+    result = {}
+    for root, _, files in os.walk(root_dir):
+        for f in files:
+            if f.lower().endswith(".docx") and not f.startswith("~"):
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                result[os.path.abspath(path)] = (st.st_mtime_ns, st.st_size)
+    return result
+
+
+def intern_key(docx, intermediate=WATCH_CONFIG["INTERMEDIATE"]):
+    """docx 对应的中间产物在存储中的键：<分册名>/<页面名><后缀>，与 internEpubs 的目录布局一致"""
+    return page_key(Path(docx).parent.name, docx, intermediate)
+
+
+def list_pages(store, intermediate=WATCH_CONFIG["INTERMEDIATE"]):
+    """存储中所有分册的页面键"""
+    return [
+        k for k in store.keys()
+        if k.count("/") == 1 and not k.startswith("_") and k.endswith(page_suffix(intermediate))
+    ]
+
+
+def initial_changes(current, store, intermediate=WATCH_CONFIG["INTERMEDIATE"], final_root=None):
+    """启动时对比已有的中间产物，找出需要转换的页面、需要删除的键和需要重建的分册
+
+    上次退出时页面可能已经转换完但分册还没来得及重建，因此分册文件缺失或
+    比其中最新的页面更旧时也需要重建。
+
+    :return: (需要转换的 docx 列表, 需要删除的键列表, 需要重建的分册名集合)
+    """
+    changed = []
+    expected = set()
+    for docx, (mtime_ns, _) in current.items():
+        key = intern_key(docx, intermediate)
+        expected.add(key)
+        if key not in store or store.mtime(key) < mtime_ns / 1e9:
+            changed.append(docx)
+
+    orphans = [k for k in list_pages(store, intermediate) if k not in expected]
+
+    stale_books = set()
+    if final_root is not None:
+        newest = {}
+        for key in list_pages(store, intermediate):
+            book = key.split("/")[0]
+            newest[book] = max(newest.get(book, 0), store.mtime(key))
+        for book, mtime in newest.items():
+            output = os.path.join(final_root, f"{book}.epub")
+            if not os.path.exists(output) or os.path.getmtime(output) < mtime:
+                stale_books.add(book)
+    return changed, orphans, stale_books
+
+
+def diff_snapshots(old, new):
+    """返回 (新增, 修改, 删除) 的 docx 列表"""
+    added = [p for p in new if p not in old]
+    changed = [p for p in new if p in old and new[p] != old[p]]
+    deleted = [p for p in old if p not in new]
+    return added, changed, deleted
+
+
+def sync_pages(to_convert, to_delete, store, converter, root_dir=None,
+               intermediate=WATCH_CONFIG["INTERMEDIATE"]):
+    """转换新增/修改的页面，删除已移除页面的中间产物
+
+    :param to_delete: 需要删除的中间产物键
+    :param converter: 转换后端实例（见 backends.py）
+    :return: (受影响的分册名集合, 转换失败的 docx 列表)
+    """
+    affected = set()
+    failed = []
+    for key in to_delete:
+        if key in store:
+            store.delete(key)
+            logging.info(f"已删除过期的中间产物: {key}")
+        affected.add(key.split("/")[0])
+
+    for docx in to_convert:
+        key = intern_key(docx, intermediate)
+        affected.add(key.split("/")[0])
+        hierarchy = hierarchy_of(os.path.dirname(docx), root_dir)
+        try:
+            ok = convert_page(docx, key, converter, store, intermediate, hierarchy) is not None
+        except Exception as e:
+            # 监视进程需要长期运行，任何单页错误都只记为该页转换失败
+            logging.error(f"转换页面出错: {docx} - {str(e)}")
+            ok = False
+        if not ok:
+            failed.append(docx)
+    return affected, failed
+
+
+def rebuild_books(book_names, store, final_root, author=WATCH_CONFIG["AUTHOR"],
+                  intermediate=WATCH_CONFIG["INTERMEDIATE"]):
+    """重建指定的分册；分册中已经没有页面时删除该分册，返回重建成功的分册名"""
+    rebuilt = []
+    for name in sorted(book_names):
+        keys = page_keys(store, name, intermediate)
+        output = os.path.join(final_root, f"{name}.epub")
+        if not keys:
+            if os.path.exists(output):
+                os.remove(output)
+                logging.info(f"分册已无页面，删除: {output}")
+            continue
+        logging.info(f"Rebuilding {name}...")
+        output_key = f"_books/{name}.epub"
+        try:
+            if merge_book(store, keys, output_key, title=name, author=author,
+                          intermediate=intermediate, sort=BOOK_SORT):
+                store.export(output_key, output)
+                rebuilt.append(name)
+        except Exception as e:
+            # 例如找不到 calibre-debug，记录后继续重建其他分册
+            logging.error(f"重建分册出错: {name} - {str(e)}")
+            print(f"重建分册出错: {name} - {str(e)}")
+        finally:
+            store.delete(output_key)
+    return rebuilt
+
+
+def rebuild_omnibus(final_root, title, author, store=None,
+                    intermediate=WATCH_CONFIG["INTERMEDIATE"]):
+    """把所有分册合成一本合集；章节包模式下直接由存储中的全部章节包生成"""
+    output = os.path.join('', f'{title}.epub')
+    if intermediate == "bundle":
+        keys = list_pages(store, intermediate)
+        if not keys:
+            return False
+        try:
+            merge_book(store, keys, "_books/_omnibus.epub", title=title, author=author, intermediate="bundle")
+            store.export("_books/_omnibus.epub", output)
+        finally:
+            store.delete("_books/_omnibus.epub")
+        return True
+    if not os.path.isdir(final_root) or not any(f.endswith(".epub") for f in os.listdir(final_root)):
+        return False
+    if not merge_epub_folder(final_root, output=output, title=title, author=author, sort=BOOK_SORT):
+        return False
+    fix_unknown_titles(output)
+    return True
+
+
+def run_watch(
+    root_dir,
+    interval=WATCH_CONFIG["INTERVAL"],
+    debounce=WATCH_CONFIG["DEBOUNCE"],
+    intern_root=WATCH_CONFIG["INTERN_FOLDER"],
+    final_root=WATCH_CONFIG["FINAL_FOLDER"],
+    author=WATCH_CONFIG["AUTHOR"],
+    omnibus_title=None,
+    omnibus_author=None,
+    libreoffice_path=DEFAULT_CONFIG["LIBREOFFICE_PATH"],
+    backend=BACKEND_CONFIG["DEFAULT_BACKEND"],
+    intermediate=WATCH_CONFIG["INTERMEDIATE"],
+    once=False,
+    pandoc_server=None,
+    start_pandoc_server=False
+):
+    """监视入口，直到 Ctrl+C（或 once 模式下同步一次）才返回
+
+    :param omnibus_title: 设置后每个周期结束时同时重建合集
+    :param once: 只做一次同步后退出
+    :param pandoc_server: 已运行的 pandoc server 地址；start_pandoc_server 为 True 时在本地启动一个
+    """
+    os.makedirs(final_root, exist_ok=True)
+    store = IntermediateStore(spill_dir=intern_root)
+    try:
+        with get_backend(backend, libreoffice_path=libreoffice_path,
+                         pandoc_server=pandoc_server, start_server=start_pandoc_server) as converter:
+            _watch_loop(root_dir, interval, debounce, store, final_root, author,
+                        omnibus_title, omnibus_author, converter, intermediate, once)
+    finally:
+        # 退出（包括 Ctrl+C）时把内存中的中间产物写回 internEpubs，下次启动可以直接复用
+        store.flush()
+        store.close()
+
+
+def _watch_loop(root_dir, interval, debounce, store, final_root, author,
+                omnibus_title, omnibus_author, converter, intermediate, once):
+    synced = snapshot(root_dir)
+    to_convert, to_delete, stale_books = initial_changes(synced, store, intermediate, final_root)
+    last_seen = synced
+    last_change = 0.0
+    dirty = bool(to_convert or to_delete or stale_books)
+    cycle = 0
+    print(f"开始监视 {os.path.abspath(root_dir)}，共 {len(synced)} 个页面，待同步 {len(to_convert) + len(to_delete)} 个，"
+          f"待重建分册 {len(stale_books)} 个")
+
+    while True:
+        if dirty and time.time() - last_change >= debounce:
+            cycle += 1
+            started = time.time()
+            affected, failed = sync_pages(to_convert, to_delete, store, converter, root_dir, intermediate)
+            affected |= stale_books
+            stale_books = set()
+            rebuilt = rebuild_books(affected, store, final_root, author, intermediate)
+            omnibus = False
+            if omnibus_title and affected:
+                try:
+                    omnibus = rebuild_omnibus(final_root, omnibus_title, omnibus_author or author,
+                                              store, intermediate)
+                except Exception as e:
+                    logging.error(f"重建合集出错: {str(e)}")
+                    print(f"重建合集出错: {str(e)}")
+
+            summary = (
+                f"[周期 {cycle}] 转换 {len(to_convert) - len(failed)}/{len(to_convert)} 页，"
+                f"删除 {len(to_delete)} 页，重建分册 {len(rebuilt)}/{len(affected)}"
+                f"{'，已重建合集' if omnibus else ''}，耗时 {time.time() - started:.1f}s"
+            )
+            if failed:
+                summary += f"，失败: {', '.join(os.path.basename(p) for p in failed)}"
+            print(summary)
+            logging.info(summary)
+
+            # 转换失败的页面也按当前快照记为已同步，docx 再次变化（或重启）时才重试，
+            # 否则总是失败的页面会在每次扫描时立即重新转换、重建分册
+            synced = dict(last_seen)
+            for p in failed:
+                logging.warning(f"转换失败，文件变化后重试: {p}")
+            to_convert, to_delete = [], []
+            dirty = False
+            if once:
+                return
+
+        if once and not dirty:
+            return
+        time.sleep(interval)
+
+        current = snapshot(root_dir)
+        if current != last_seen:
+            last_seen = current
+            last_change = time.time()
+        added, changed, deleted = diff_snapshots(synced, last_seen)
+        to_convert = added + changed
+        to_delete = [intern_key(p, intermediate) for p in deleted]
+        dirty = bool(to_convert or to_delete)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="监视 OneNoteExport 目录并增量重建 epub")
+    parser.add_argument("root", help="OneNoteExport 根目录")
+    parser.add_argument("--interval", type=float, default=WATCH_CONFIG["INTERVAL"], help="扫描间隔（秒）")
+    parser.add_argument("--debounce", type=float, default=WATCH_CONFIG["DEBOUNCE"], help="防抖时间（秒）")
+    parser.add_argument("-a", "--author", default=WATCH_CONFIG["AUTHOR"], help="分册作者")
+    parser.add_argument("--omnibus-title", default=None, help="设置后同时重建合集")
+    parser.add_argument("--omnibus-author", default=None, help="合集作者，默认与分册作者相同")
+    parser.add_argument("--libreoffice-path", default=DEFAULT_CONFIG["LIBREOFFICE_PATH"], help="LibreOffice 路径")
+    parser.add_argument("--backend", choices=list(BACKENDS), default=BACKEND_CONFIG["DEFAULT_BACKEND"], help="转换后端")
+    parser.add_argument("--pandoc-server", default=None, help="已运行的 pandoc server 地址")
+    parser.add_argument("--start-pandoc-server", action="store_true", help="在本地启动 pandoc server")
+    parser.add_argument("--intermediate", choices=["epub", "bundle"], default=WATCH_CONFIG["INTERMEDIATE"],
+                        help="中间格式：单页 epub 或章节包")
+    parser.add_argument("--once", action="store_true", help="同步一次后退出")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.root):
+        print(f"错误: 文件夹 '{args.root}' 不存在")
+        return 1
+
+    setup_logger()
+    try:
+        run_watch(
+            args.root,
+            interval=args.interval,
+            debounce=args.debounce,
+            author=args.author,
+            omnibus_title=args.omnibus_title,
+            omnibus_author=args.omnibus_author,
+            libreoffice_path=args.libreoffice_path,
+            backend=args.backend,
+            intermediate=args.intermediate,
+            once=args.once,
+            pandoc_server=args.pandoc_server,
+            start_pandoc_server=args.start_pandoc_server
+        )
+    except KeyboardInterrupt:
+        print("已停止监视")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多机转换工作队列
+把 docx -> epub 的转换任务发布到共享存储上的 SQLite 队列文件中，
+任意数量的 worker 进程（可以在不同主机上）从队列领取任务并完成转换。
+
+- 任务按 docx 文件大小从大到小派发，尽量缩短整体完成时间
+- worker 领取任务时获得一个租约，转换过程中定期续约；
+  worker 失联后，租约超时的任务会重新回到队列
+- 队列中保存的是绝对路径，多台主机需要把共享存储挂载到相同的路径
+"""
+
+import os
+import sys
+import time
+import json
+import uuid
+import socket
+import sqlite3
+import logging
+import argparse
+import tempfile
+import threading
+import shutil
+import multiprocessing
+from pathlib import Path
+
+from coreConver import DEFAULT_CONFIG, get_docx_files
+from backends import BACKENDS, BACKEND_CONFIG, PandocBackend, get_backend
+import governor
+from storage import IntermediateStore
+from pipeline import convert_page, page_key
+from bundle import hierarchy_of
+
+# 默认配置
+QUEUE_CONFIG = {
+    "LEASE_SECONDS": 600,   # 租约时长，超过该时间没有续约的任务会被重新派发
+    "POLL_INTERVAL": 5,     # 队列暂时为空时的轮询间隔（秒）
+    "MAX_ATTEMPTS": 3,      # 单个任务最多尝试次数，超过后标记为 failed
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    source TEXT NOT NULL UNIQUE,
+    output_folder TEXT NOT NULL,
+    hierarchy TEXT,
+    size INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_dispatch ON jobs (state, size);
+"""
+
+
+def connect_queue(queue_path):
+    """打开（必要时创建）队列数据库
+
+    共享存储（NFS/SMB）上不能使用 WAL，这里保持 SQLite 默认的回滚日志模式，
+    并用 BEGIN IMMEDIATE 保证领取任务的原子性。
+    """
+    conn = sqlite3.connect(queue_path, timeout=60, isolation_level=None)
+    conn.executescript(SCHEMA)
+    # 旧版本创建的队列没有 hierarchy 列
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+    if "hierarchy" not in columns:
+        conn.execute("ALTER TABLE jobs ADD COLUMN hierarchy TEXT")
+    return conn
+
+
+def publish_jobs(queue_path, docx_folders, output_root='internEpubs', root_dir=None):
+    """把各文件夹中的 docx 文件发布为转换任务
+
+    :param queue_path: 队列数据库路径
+    :param docx_folders: 包含 docx 文件的文件夹列表（见 main.find_docx_folders）
+    :param output_root: 中间 epub 的输出根目录，每个文件夹对应其中的一个子目录
+    :param root_dir: OneNoteExport 根目录，用于记录章节包的层级路径（笔记本/分区组/分区）
+    :return: 输出子目录列表，与 main.ConvertFirst 的返回值一致
+    """
+    output_root = os.path.abspath(output_root)
+    EpubList = []
+    now = time.time()
+    conn = connect_queue(queue_path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        for folder in docx_folders:
+            output_dir = os.path.join(output_root, Path(folder).name)
+            hierarchy = json.dumps(hierarchy_of(folder, root_dir), ensure_ascii=False)
+            for docx in get_docx_files(folder):
+                docx = os.path.abspath(docx)
+                # 已发布过的文件重新置为待处理，以便重跑时覆盖旧结果
+                conn.execute(
+                    "INSERT INTO jobs (source, output_folder, hierarchy, size, updated) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(source) DO UPDATE SET output_folder=excluded.output_folder, "
+                    "hierarchy=excluded.hierarchy, size=excluded.size, state='pending', worker=NULL, lease_until=NULL, "
+                    "attempts=0, error=NULL, updated=excluded.updated",
+                    (docx, output_dir, hierarchy, os.path.getsize(docx), now)
+                )
+            EpubList.append(output_dir)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    logging.info(f"已发布 {len(EpubList)} 个文件夹的转换任务到 {queue_path}")
+    return EpubList
+
+
+def claim_job(conn, worker_id, lease_seconds=QUEUE_CONFIG["LEASE_SECONDS"],
+              max_attempts=QUEUE_CONFIG["MAX_ATTEMPTS"]):
+    """领取当前最大的待处理任务，返回 (id, source, output_folder, hierarchy)，没有任务时返回 None"""
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # 回收租约已过期的任务
+        conn.execute(
+            "UPDATE jobs SET state=CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "worker=NULL, lease_until=NULL, error='lease expired', updated=? "
+            "WHERE state='running' AND lease_until < ?",
+            (max_attempts, now, now)
+        )
+        row = conn.execute(
+            "SELECT id, source, output_folder, hierarchy FROM jobs WHERE state='pending' "
+            "ORDER BY size DESC, id LIMIT 1"
+        ).fetchone()
+        if row is not None:
+            conn.execute(
+                "UPDATE jobs SET state='running', worker=?, lease_until=?, "
+                "attempts=attempts+1, updated=? WHERE id=?",
+                (worker_id, now + lease_seconds, now, row[0])
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return row
+
+
+def renew_lease(conn, job_id, worker_id, lease_seconds=QUEUE_CONFIG["LEASE_SECONDS"]):
+    """续约，返回 False 表示任务已经被回收给其他 worker"""
+    cur = conn.execute(
+        "UPDATE jobs SET lease_until=? WHERE id=? AND worker=? AND state='running'",
+        (time.time() + lease_seconds, job_id, worker_id)
+    )
+    return cur.rowcount == 1
+
+
+def finish_job(conn, job_id, worker_id, success, error=None,
+               max_attempts=QUEUE_CONFIG["MAX_ATTEMPTS"]):
+    """提交任务结果；失败的任务在尝试次数用完前会重新回到队列"""
+    if success:
+        conn.execute(
+            "UPDATE jobs SET state='done', lease_until=NULL, error=NULL, updated=? "
+            "WHERE id=? AND worker=?",
+            (time.time(), job_id, worker_id)
+        )
+    else:
+        conn.execute(
+            "UPDATE jobs SET state=CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "worker=NULL, lease_until=NULL, error=?, updated=? WHERE id=? AND worker=?",
+            (max_attempts, error, time.time(), job_id, worker_id)
+        )
+
+
+def queue_status(queue_path):
+    """返回各状态的任务数量"""
+    conn = connect_queue(queue_path)
+    try:
+        rows = conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall()
+    finally:
+        conn.close()
+    status = {"pending": 0, "running": 0, "done": 0, "failed": 0}
+    status.update(dict(rows))
+    return status
+
+
+def _heartbeat(queue_path, job_id, worker_id, lease_seconds, stop):
+    """转换期间定期续约，避免长时间转换被误判为失联"""
+    conn = connect_queue(queue_path)
+    try:
+        while not stop.wait(lease_seconds / 3):
+            if not renew_lease(conn, job_id, worker_id, lease_seconds):
+                logging.warning(f"任务 {job_id} 的租约已被回收")
+                return
+    finally:
+        conn.close()
+
+
+def run_worker(
+    queue_path,
+    worker_id=None,
+    lease_seconds=QUEUE_CONFIG["LEASE_SECONDS"],
+    poll_interval=QUEUE_CONFIG["POLL_INTERVAL"],
+    max_attempts=QUEUE_CONFIG["MAX_ATTEMPTS"],
+    exit_when_empty=True,
+    libreoffice_path=DEFAULT_CONFIG["LIBREOFFICE_PATH"],
+    backend=BACKEND_CONFIG["DEFAULT_BACKEND"],
+    intermediate="epub",
+    memory_budget=None,
+    pandoc_server=None,
+    start_pandoc_server=False
+):
+    """worker 主循环：领取任务 -> 转换 -> 提交结果
+
+    :param intermediate: "epub" 或 "bundle"（见 bundle.py），所有 worker 需保持一致
+    :param memory_budget: 本 worker 子进程的内存预算（字节，见 governor.py），
+                          同一台机器上运行多个 worker 时应平分总预算
+    :param pandoc_server: 已运行的 pandoc server 地址；start_pandoc_server 为 True 时本 worker 启动自己的 server
+    :param exit_when_empty: 为 True 时，队列中既没有待处理也没有进行中的任务就退出；
+                            为 False 时一直等待新任务
+    :return: 本 worker 成功完成的任务数
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    if memory_budget is not None:
+        governor.configure(memory_budget=memory_budget)
+    # 每个 worker 使用独立的 LibreOffice 配置目录
+    profile_dir = tempfile.mkdtemp(prefix="lo_profile_")
+    converter = get_backend(backend, libreoffice_path=libreoffice_path, user_installation=profile_dir,
+                            pandoc_server=pandoc_server, start_server=start_pandoc_server)
+    # 结果直接写入共享存储（内存预算为 0），每个输出根目录对应一个存储
+    stores = {}
+    conn = connect_queue(queue_path)
+    done_count = 0
+    logging.info(f"worker {worker_id} 启动，队列: {queue_path}")
+    try:
+        while True:
+            job = claim_job(conn, worker_id, lease_seconds, max_attempts)
+            if job is None:
+                if exit_when_empty:
+                    remaining = conn.execute(
+                        "SELECT COUNT(*) FROM jobs WHERE state IN ('pending', 'running')"
+                    ).fetchone()[0]
+                    if remaining == 0:
+                        break
+                time.sleep(poll_interval)
+                continue
+
+            job_id, source, output_folder, hierarchy = job
+            logging.info(f"worker {worker_id} 领取任务 {job_id}: {source}")
+            stop = threading.Event()
+            heartbeat = threading.Thread(
+                target=_heartbeat,
+                args=(queue_path, job_id, worker_id, lease_seconds, stop),
+                daemon=True
+            )
+            heartbeat.start()
+            error = None
+            try:
+                output_root = os.path.dirname(os.path.abspath(output_folder))
+                if output_root not in stores:
+                    stores[output_root] = IntermediateStore(spill_dir=output_root, memory_budget=0)
+                key = page_key(Path(output_folder).name, source, intermediate)
+                success = convert_page(source, key, converter, stores[output_root], intermediate,
+                                       json.loads(hierarchy) if hierarchy else None) is not None
+                if not success:
+                    error = "conversion failed"
+            except Exception as e:
+                success = False
+                error = str(e)
+                logging.error(f"任务 {job_id} 出错: {source} - {error}")
+            finally:
+                stop.set()
+                heartbeat.join()
+
+            finish_job(conn, job_id, worker_id, success, error, max_attempts)
+            if success:
+                done_count += 1
+    finally:
+        conn.close()
+        converter.close()
+        for store in stores.values():
+            store.close()
+        shutil.rmtree(profile_dir, ignore_errors=True)
+    logging.info(f"worker {worker_id} 退出，完成 {done_count} 个任务")
+    return done_count
+
+
+def run_local_workers(queue_path, workers=os.cpu_count(), **worker_kwargs):
+    """在本机启动多个 worker 进程并等待队列清空，返回队列最终状态
+
+    各 worker 有独立的内存准入控制，默认平分本机的内存预算（见 governor.py）。
+    start_pandoc_server 为 True 时只在本进程启动一个 pandoc server，所有 worker 共用
+    """
+    if worker_kwargs.get("memory_budget") is None:
+        budget = governor.default_memory_budget()
+        if budget is not None:
+            worker_kwargs["memory_budget"] = budget // max(workers, 1)
+    server = None
+    if worker_kwargs.pop("start_pandoc_server", False) and not worker_kwargs.get("pandoc_server"):
+        server = PandocBackend(start_server=True)
+        worker_kwargs["pandoc_server"] = server.server_url
+    try:
+        processes = [
+            multiprocessing.Process(target=run_worker, args=(queue_path,), kwargs=worker_kwargs)
+            for _ in range(workers)
+        ]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+    finally:
+        if server is not None:
+            server.close()
+    return queue_status(queue_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="多机 docx -> epub 转换工作队列")
+    parser.add_argument("queue", help="队列数据库路径（放在所有主机都能访问的共享存储上）")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_publish = sub.add_parser("publish", help="扫描 OneNoteExport 目录并发布转换任务")
+    p_publish.add_argument("root", help="OneNoteExport 根目录")
+    p_publish.add_argument("-o", "--output", help="中间 epub 输出根目录", default="internEpubs")
+
+    p_worker = sub.add_parser("worker", help="启动一个 worker")
+    p_local = sub.add_parser("local", help="在本机启动多个 worker")
+    p_local.add_argument("-n", "--workers", type=int, default=os.cpu_count(), help="worker 进程数")
+    for p in (p_worker, p_local):
+        p.add_argument("--lease", type=int, default=QUEUE_CONFIG["LEASE_SECONDS"], help="租约时长（秒）")
+        p.add_argument("--poll", type=int, default=QUEUE_CONFIG["POLL_INTERVAL"], help="轮询间隔（秒）")
+        p.add_argument("--max-attempts", type=int, default=QUEUE_CONFIG["MAX_ATTEMPTS"], help="单个任务最多尝试次数")
+        p.add_argument("--forever", action="store_true", help="队列为空时继续等待新任务")
+        p.add_argument("--libreoffice-path", default=DEFAULT_CONFIG["LIBREOFFICE_PATH"], help="LibreOffice 路径")
+        p.add_argument("--backend", choices=list(BACKENDS), default=BACKEND_CONFIG["DEFAULT_BACKEND"], help="转换后端")
+        p.add_argument("--intermediate", choices=["epub", "bundle"], default="epub", help="中间格式：单页 epub 或章节包")
+        p.add_argument("--pandoc-server", default=None, help="已运行的 pandoc server 地址")
+        p.add_argument("--start-pandoc-server", action="store_true",
+                       help="在本地启动 pandoc server（local 模式下所有 worker 共用一个）")
+        p.add_argument("--memory-budget", type=int, default=None,
+                       help="子进程内存预算（MB），local 模式下为所有 worker 的总预算，默认见 governor.py")
+
+    sub.add_parser("status", help="查看队列状态")
+    args = parser.parse_args()
+
+    if args.command == "publish":
+        from main import find_docx_folders
+        folders = find_docx_folders(args.root)
+        publish_jobs(args.queue, folders, args.output, root_dir=args.root)
+        print(f"已发布 {len(folders)} 个文件夹的任务")
+    elif args.command in ("worker", "local"):
+        worker_kwargs = dict(
+            lease_seconds=args.lease,
+            poll_interval=args.poll,
+            max_attempts=args.max_attempts,
+            exit_when_empty=not args.forever,
+            libreoffice_path=args.libreoffice_path,
+            backend=args.backend,
+            intermediate=args.intermediate,
+            pandoc_server=args.pandoc_server,
+            start_pandoc_server=args.start_pandoc_server
+        )
+        if args.memory_budget is not None:
+            budget = args.memory_budget * governor.MB
+            worker_kwargs["memory_budget"] = budget if args.command == "worker" else budget // max(args.workers, 1)
+        if args.command == "worker":
+            print(f"完成 {run_worker(args.queue, **worker_kwargs)} 个任务")
+        else:
+            run_local_workers(args.queue, args.workers, **worker_kwargs)
+    print(queue_status(args.queue))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())